@@ -0,0 +1,235 @@
+import time
+from pathlib import Path
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+from PIL import GifImagePlugin, Image, ImageSequence
+
+from . import profiling
+from .backend import get_backend
+from .classes import Emoji
+from .constants import FRAME_DURATION, MEMORY_BUDGET, TOP_K
+from .emoji_store import collapse_duplicates
+from .mosaic import (
+    decode_emoji_cells,
+    get_channel_weights,
+    get_device,
+    image_to_source_tiles,
+    load_match_tiles,
+    load_palette_index,
+    match_source_tiles,
+    to_device,
+)
+
+
+def iter_frames(source_path: Path) -> Iterator[Tuple[Image.Image, int]]:
+    # Frames are decoded one at a time as the animation is matched
+    with Image.open(source_path) as image:
+        for frame in ImageSequence.Iterator(image):
+            duration = frame.info.get('duration') or FRAME_DURATION
+            yield frame.convert('RGBA'), int(duration)
+
+
+def run_animation(
+    emojis: List[Emoji],
+    images_path: Path,
+    source_path: Path,
+    width_emojis: int,
+    resize: Tuple[int, int],
+    resample: int,
+    hue_weight: float,
+    saturation_weight: float,
+    value_weight: float,
+    memory_budget: int = MEMORY_BUDGET,
+    cache_path: Optional[Path] = None,
+    matcher: str = 'exact',
+    top_k: int = TOP_K,
+    metric: str = 'l1',
+    reuse_threshold: float = 0,
+    stats: Optional[Dict[str, float]] = None,
+) -> Iterator[Tuple[List[List[Emoji]], int]]:
+    emojis = collapse_duplicates(emojis, images_path)
+    backend = get_backend()
+    device = get_device()
+    match_tiles = to_device(
+        load_match_tiles(emojis, images_path, resize, resample, cache_path),
+        device,
+    )
+    channel_weights = get_channel_weights(
+        hue_weight, saturation_weight, value_weight, device
+    )
+    palette_index = load_palette_index(
+        match_tiles,
+        channel_weights,
+        resize,
+        resample,
+        memory_budget,
+        cache_path,
+        matcher,
+        metric,
+    )
+
+    reference_tiles = None
+    closest_tiles = None
+    frame_count = 0
+    matched_count = 0
+    tile_count = 0
+    match_seconds = 0.0
+    for frame, duration in iter_frames(source_path):
+        source_tiles = to_device(
+            image_to_source_tiles(frame, width_emojis, resize, resample),
+            device,
+        )
+        start_time = time.perf_counter()
+        if reference_tiles is None:
+            changed = np.arange(len(source_tiles))
+            reference_tiles = source_tiles
+        else:
+            # A tile keeps its emoji while it stays within the threshold of
+            # the tile it was last matched with, so slow changes still
+            # add up to a new match
+            distances = backend.tile_distances(
+                reference_tiles, source_tiles, channel_weights
+            )
+            changed = np.flatnonzero(
+                backend.to_numpy(distances)
+                > reuse_threshold * resize[0] * resize[1]
+            )
+            changed_positions = backend.from_numpy(changed, device)
+            reference_tiles[changed_positions] = source_tiles[
+                changed_positions
+            ]
+
+        if len(changed):
+            changed_closest = match_source_tiles(
+                emojis,
+                match_tiles,
+                source_tiles[backend.from_numpy(changed, device)],
+                channel_weights,
+                resize,
+                resample,
+                memory_budget,
+                cache_path,
+                matcher,
+                top_k,
+                metric,
+                palette_index=palette_index,
+            )
+            if closest_tiles is None:
+                closest_tiles = backend.to_numpy(changed_closest)
+            else:
+                closest_tiles[changed] = backend.to_numpy(changed_closest)
+        match_seconds += time.perf_counter() - start_time
+
+        frame_count += 1
+        matched_count += len(changed)
+        tile_count += len(source_tiles)
+        yield [
+            [emojis[index] for index in row]
+            for row in closest_tiles.reshape((width_emojis, -1)).T.tolist()
+        ], duration
+
+    if stats is not None:
+        stats['frames'] = frame_count
+        stats['match_seconds'] = match_seconds
+        stats['matched_tiles'] = matched_count
+        stats['reuse_ratio'] = 1 - matched_count / max(1, tile_count)
+
+
+class GifWriter:
+    def __init__(
+        self, file: BinaryIO, images_path: Path, cell_size: Tuple[int, int]
+    ) -> None:
+        self.file = file
+        self.images_path = images_path
+        self.cell_size = cell_size
+        self.palette: Optional[Image.Image] = None
+        self.cells: Dict[Emoji, np.ndarray] = {}
+        self.grid: Optional[List[List[Emoji]]] = None
+        self.pending: Optional[Tuple[Image.Image, Tuple[int, int], int]] = None
+
+    def quantized_cells(self, emojis: List[Emoji]) -> None:
+        new_emojis = [emoji for emoji in emojis if emoji not in self.cells]
+        if not new_emojis:
+            return
+        cells = decode_emoji_cells(
+            new_emojis, self.images_path, self.cell_size
+        )
+        strip = Image.fromarray(cells.reshape(-1, self.cell_size[0], 3))
+        if self.palette is None:
+            # Every frame is made of emoji cells, so one palette chosen from
+            # the first frame's emojis serves the whole animation, and each
+            # cell is quantized only once
+            self.palette = strip.quantize(256)
+        indices = np.asarray(
+            strip.quantize(palette=self.palette, dither=Image.Dither.NONE)
+        )
+        for emoji, cell in zip(
+            new_emojis, indices.reshape(len(new_emojis), *cells.shape[1:3])
+        ):
+            self.cells[emoji] = cell
+
+    def write_frame(
+        self, emoji_rows: List[List[Emoji]], duration: int
+    ) -> None:
+        unique_emojis = list(
+            dict.fromkeys(emoji for row in emoji_rows for emoji in row)
+        )
+        with profiling.stage('decode_emojis'):
+            self.quantized_cells(unique_emojis)
+
+        # Only the rectangle of cells that changed since the previous frame
+        # is written, and the rest of the previous frame is left in place
+        if self.grid is None:
+            top, left = 0, 0
+            bottom, right = len(emoji_rows), len(emoji_rows[0])
+        else:
+            changed = np.array(emoji_rows, dtype=object) != np.array(
+                self.grid, dtype=object
+            )
+            if not changed.any():
+                image, offset, pending_duration = self.pending
+                self.pending = (image, offset, pending_duration + duration)
+                return
+            rows = np.flatnonzero(changed.any(1))
+            columns = np.flatnonzero(changed.any(0))
+            top, bottom = rows[0], rows[-1] + 1
+            left, right = columns[0], columns[-1] + 1
+        self.grid = emoji_rows
+
+        cell_width, cell_height = self.cell_size
+        pixels = np.empty(
+            ((bottom - top) * cell_height, (right - left) * cell_width),
+            dtype=np.uint8,
+        )
+        cells = pixels.reshape(bottom - top, cell_height, right - left, -1)
+        for row_index, row in enumerate(emoji_rows[top:bottom]):
+            for column_index, emoji in enumerate(row[left:right]):
+                cells[row_index, :, column_index] = self.cells[emoji]
+        image = Image.fromarray(pixels)
+        image.putpalette(self.palette.getpalette())
+
+        if self.pending is None:
+            header, _ = GifImagePlugin.getheader(image, info={'loop': 0})
+            self.file.write(b''.join(header))
+        else:
+            self.flush()
+        self.pending = (
+            image,
+            (left * cell_width, top * cell_height),
+            duration,
+        )
+
+    def flush(self) -> None:
+        if self.pending is None:
+            return
+        image, offset, duration = self.pending
+        # Disposal 1 keeps the previous frame under a partial frame
+        for data in GifImagePlugin.getdata(
+            image, offset, duration=duration, disposal=1
+        ):
+            self.file.write(data)
+
+    def close(self) -> None:
+        self.flush()
+        self.file.write(b';')
@@ -0,0 +1,113 @@
+import importlib.util
+from typing import TYPE_CHECKING, Any, List, Optional, Tuple, Union
+
+import numpy as np
+from PIL import Image
+
+from .constants import BACKENDS, MEMORY_BUDGET
+
+if TYPE_CHECKING:
+    import torch
+
+Array = Union['torch.Tensor', np.ndarray]
+
+
+def block_sizes(
+    match_count: int, source_count: int, pair_bytes: int, memory_budget: int
+) -> Tuple[int, int]:
+    pairs = max(1, memory_budget // pair_bytes)
+    match_block = max(1, min(match_count, pairs))
+    source_block = max(1, min(source_count, pairs // match_block))
+    return match_block, source_block
+
+
+class Backend:
+    name = ''
+
+    @property
+    def device(self) -> Any:
+        raise NotImplementedError
+
+    def to_device(self, array: Array, device: Any) -> Array:
+        raise NotImplementedError
+
+    def tiles_from_image(
+        self, image: Image.Image, tile_size: Tuple[int, int]
+    ) -> Array:
+        raise NotImplementedError
+
+    def tiles_from_features(self, features: np.ndarray) -> Array:
+        raise NotImplementedError
+
+    def channel_weights(self, weights: List[float], device: Any) -> Array:
+        raise NotImplementedError
+
+    def concatenate(self, arrays: List[Array]) -> Array:
+        raise NotImplementedError
+
+    def to_numpy(self, array: Array) -> np.ndarray:
+        raise NotImplementedError
+
+    def from_numpy(self, array: np.ndarray, device: Any) -> Array:
+        raise NotImplementedError
+
+    def deduplicate_tiles(self, source_tiles: Array) -> Tuple[Array, Array]:
+        raise NotImplementedError
+
+    def find_closest_tiles(
+        self,
+        match_tiles: Array,
+        source_tiles: Array,
+        channel_weights: Array,
+        memory_budget: int = MEMORY_BUDGET,
+        metric: str = 'l1',
+    ) -> Array:
+        raise NotImplementedError
+
+    def find_closest_tiles_sweep(
+        self,
+        match_tiles: Array,
+        source_tiles: Array,
+        channel_weight_sets: List[Array],
+        memory_budget: int = MEMORY_BUDGET,
+        metric: str = 'l1',
+    ) -> Array:
+        raise NotImplementedError
+
+    def tile_distances(
+        self,
+        match_tiles: Array,
+        source_tiles: Array,
+        channel_weights: Array,
+        metric: str = 'l1',
+    ) -> Array:
+        raise NotImplementedError
+
+
+backend: Optional[Backend] = None
+
+
+def set_backend(name: str = 'auto') -> Backend:
+    global backend
+    if name == 'auto':
+        # Checking for torch without importing it keeps the NumPy backend's
+        # start-up fast
+        name = 'torch' if importlib.util.find_spec('torch') else 'numpy'
+
+    if name == 'torch':
+        from .torch_backend import TorchBackend
+
+        backend = TorchBackend()
+    elif name == 'numpy':
+        from .numpy_backend import NumpyBackend
+
+        backend = NumpyBackend()
+    else:
+        raise ValueError(f'Unknown backend "{name}", expected {BACKENDS}')
+    return backend
+
+
+def get_backend() -> Backend:
+    if backend is None:
+        return set_backend()
+    return backend
@@ -0,0 +1,132 @@
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Deque, Iterator, List, Optional, Tuple
+
+from PIL import Image
+
+from .backend import Array
+from .classes import Emoji
+from .constants import BATCH_WORKERS, MEMORY_BUDGET, TOP_K
+from .emoji_store import collapse_duplicates
+from .mosaic import (
+    get_channel_weights,
+    get_device,
+    load_match_tiles,
+    load_palette_index,
+    load_source_tiles,
+    match_mosaic,
+    to_device,
+)
+
+
+def find_sources(sources_path: Path, pattern: str) -> List[Path]:
+    path = sources_path.joinpath(pattern)
+    paths = path.iterdir() if path.is_dir() else sources_path.glob(pattern)
+    # Other files in the sources directory, such as notes, would abort the
+    # batch when they fail to decode
+    Image.init()
+    extensions = Image.registered_extensions()
+    return sorted(
+        path
+        for path in paths
+        if path.is_file() and path.suffix.lower() in extensions
+    )
+
+
+def timed_load_source_tiles(
+    source_path: Path,
+    width_emojis: int,
+    resize: Tuple[int, int],
+    resample: int,
+) -> Tuple[Array, float]:
+    start_time = time.perf_counter()
+    source_tiles = load_source_tiles(
+        source_path, width_emojis, resize, resample
+    )
+    return source_tiles, time.perf_counter() - start_time
+
+
+def run_batch(
+    emojis: List[Emoji],
+    images_path: Path,
+    source_paths: List[Path],
+    width_emojis: int,
+    resize: Tuple[int, int],
+    resample: int,
+    hue_weight: float,
+    saturation_weight: float,
+    value_weight: float,
+    memory_budget: int = MEMORY_BUDGET,
+    cache_path: Optional[Path] = None,
+    matcher: str = 'exact',
+    top_k: int = TOP_K,
+    metric: str = 'l1',
+    workers: int = BATCH_WORKERS,
+) -> Iterator[Tuple[Path, List[List[Emoji]], float, float]]:
+    emojis = collapse_duplicates(emojis, images_path)
+    device = get_device()
+    match_tiles = to_device(
+        load_match_tiles(emojis, images_path, resize, resample, cache_path),
+        device,
+    )
+    channel_weights = get_channel_weights(
+        hue_weight, saturation_weight, value_weight, device
+    )
+    palette_index = load_palette_index(
+        match_tiles,
+        channel_weights,
+        resize,
+        resample,
+        memory_budget,
+        cache_path,
+        matcher,
+        metric,
+    )
+
+    with ThreadPoolExecutor(workers) as executor:
+        paths = iter(source_paths)
+        pending: Deque[Tuple[Path, Future]] = deque()
+
+        def submit_next() -> None:
+            path = next(paths, None)
+            if path is not None:
+                future = executor.submit(
+                    timed_load_source_tiles,
+                    path,
+                    width_emojis,
+                    resize,
+                    resample,
+                )
+                pending.append((path, future))
+
+        # Decode a bounded number of sources ahead of the matcher, so that
+        # decoding overlaps with matching without holding every image
+        for _ in range(workers):
+            submit_next()
+
+        while pending:
+            path, future = pending.popleft()
+            submit_next()
+            source_tiles, load_seconds = future.result()
+
+            start_time = time.perf_counter()
+            output_emojis = match_mosaic(
+                emojis,
+                match_tiles,
+                to_device(source_tiles, device),
+                width_emojis,
+                channel_weights,
+                resize,
+                resample,
+                memory_budget,
+                cache_path,
+                matcher,
+                top_k,
+                metric,
+                palette_index=palette_index,
+            )
+            match_seconds = time.perf_counter() - start_time
+
+            yield path, output_emojis, load_seconds, match_seconds
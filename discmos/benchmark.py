@@ -0,0 +1,263 @@
+import json
+import multiprocessing
+import shutil
+import time
+from itertools import product
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from .constants import (
+    BENCHMARK_COMPOSITE_WIDTH,
+    BENCHMARK_MARKER_FILE,
+    BENCHMARK_SOURCES,
+    EMOJI_FILE,
+    SIZE,
+)
+from .profiling import peak_rss
+
+BenchmarkResult = Dict[str, Any]
+
+
+def random_image(
+    rng: np.random.Generator, size: Tuple[int, int], blocks: int
+) -> Image.Image:
+    pixels = np.empty((size[1], size[0], 3), dtype=np.uint8)
+    pixels[:] = rng.integers(0, 256, 3)
+    for _ in range(blocks):
+        x, y = rng.integers(0, size[0]), rng.integers(0, size[1])
+        width, height = rng.integers(1, size[0] // 2 + 2, 2)
+        pixels[y : y + height, x : x + width] = rng.integers(0, 256, 3)
+    return Image.fromarray(pixels)
+
+
+def check_benchmark_workspace(workspace: Path) -> None:
+    # The benchmark overwrites emoji-data.json, include.txt and the emojis
+    # and deletes the cache, so it only runs in a directory it created
+    if not workspace.exists():
+        return
+    if not workspace.is_dir():
+        raise ValueError(f'{workspace} is not a directory')
+    if workspace.joinpath(BENCHMARK_MARKER_FILE).is_file():
+        return
+    if any(workspace.iterdir()):
+        raise ValueError(
+            f'{workspace} is not empty and was not generated by the '
+            'benchmark, use a new or empty directory'
+        )
+
+
+def generate_workspace(
+    workspace: Path, emoji_count: int, seed: int = 0
+) -> None:
+    check_benchmark_workspace(workspace)
+    workspace.mkdir(parents=True, exist_ok=True)
+    workspace.joinpath(BENCHMARK_MARKER_FILE).touch()
+
+    emoji_data_path = workspace.joinpath('emoji-data.json')
+    if emoji_data_path.is_file():
+        emoji_data = json.loads(emoji_data_path.read_text())
+        if len(emoji_data['emojis']) >= emoji_count:
+            return
+
+    rng = np.random.default_rng(seed)
+    emojis_dir = workspace.joinpath('emojis')
+    sources_dir = workspace.joinpath('sources')
+    for directory in (emojis_dir, sources_dir):
+        directory.mkdir(parents=True, exist_ok=True)
+
+    servers = [f'Server {index}' for index in range(max(1, emoji_count // 50))]
+    emojis = []
+    for index in range(emoji_count):
+        emoji_id = 10**17 + index
+        random_image(rng, SIZE, 6).save(
+            emojis_dir.joinpath(EMOJI_FILE.format(ID=emoji_id))
+        )
+        emojis.append(
+            {
+                'id': str(emoji_id),
+                'name': f'emoji_{index}',
+                'server': servers[index % len(servers)],
+            }
+        )
+
+    for name, size in BENCHMARK_SOURCES.items():
+        random_image(rng, size, 200).save(sources_dir.joinpath(f'{name}.png'))
+
+    workspace.joinpath('include.txt').write_text('+ all\n')
+    emoji_data_path.write_text(
+        json.dumps({'servers': servers, 'emojis': emojis})
+    )
+
+
+def run_case(
+    workspace: Path,
+    palette_size: int,
+    width_emojis: int,
+    resize: int,
+    source: str,
+    backend: str = 'auto',
+) -> BenchmarkResult:
+    # Imported here so that each case pays for its own imports in its own
+    # process, like a CLI invocation
+    from .backend import set_backend
+    from .emoji_data import get_emoji_data
+    from .filter_emojis import filter_emojis
+    from .mosaic import (
+        find_closest_tiles,
+        get_channel_weights,
+        get_device,
+        load_match_tiles,
+        load_source_tiles,
+        run_composite,
+        to_device,
+    )
+
+    # Saved as the backend that ran, so that auto compares like with like
+    backend = set_backend(backend).name
+    stages: Dict[str, float] = {}
+    stage_rss: Dict[str, Optional[int]] = {}
+
+    def timed(name: str, function: Callable, *args: Any) -> Any:
+        start_time = time.perf_counter()
+        value = function(*args)
+        stages[name] = time.perf_counter() - start_time
+        stage_rss[name] = peak_rss()
+        return value
+
+    images_path = workspace.joinpath('emojis')
+    cache_path = workspace.joinpath('cache')
+    resize_size = (resize, resize)
+    device = get_device()
+
+    emoji_data = timed('data_load', get_emoji_data, workspace)
+    include = workspace.joinpath('include.txt').read_text()
+    emojis = timed('include_filter', filter_emojis, emoji_data, include)
+    emojis = emojis[:palette_size]
+
+    timed(
+        'palette_build',
+        load_match_tiles,
+        emojis,
+        images_path,
+        resize_size,
+        Image.LANCZOS,
+    )
+    # Warm the feature cache, then time loading from it
+    load_match_tiles(
+        emojis, images_path, resize_size, Image.LANCZOS, cache_path
+    )
+    match_tiles = to_device(
+        timed(
+            'palette_cached',
+            load_match_tiles,
+            emojis,
+            images_path,
+            resize_size,
+            Image.LANCZOS,
+            cache_path,
+        ),
+        device,
+    )
+
+    source_tiles = to_device(
+        timed(
+            'source_tiling',
+            load_source_tiles,
+            workspace.joinpath('sources', f'{source}.png'),
+            width_emojis,
+            resize_size,
+            Image.LANCZOS,
+        ),
+        device,
+    )
+    channel_weights = get_channel_weights(1.0, 1.0, 1.0, device)
+    closest_tiles = timed(
+        'matching',
+        find_closest_tiles,
+        match_tiles,
+        source_tiles,
+        channel_weights,
+    )
+
+    output_emojis = [
+        [emojis[index] for index in row]
+        for row in closest_tiles.reshape((width_emojis, -1)).T.tolist()
+    ]
+    cell_width = max(1, BENCHMARK_COMPOSITE_WIDTH // width_emojis)
+    timed(
+        'composite',
+        run_composite,
+        output_emojis,
+        images_path,
+        (cell_width, cell_width),
+    )
+
+    return {
+        'palette_size': len(emojis),
+        'width_emojis': width_emojis,
+        'resize': resize,
+        'source': source,
+        'backend': backend,
+        'tiles': len(source_tiles),
+        'stages': stages,
+        'stage_peak_rss': stage_rss,
+        'peak_rss': peak_rss(),
+    }
+
+
+def run_benchmark(
+    workspace: Path,
+    palette_sizes: List[int],
+    widths_emojis: List[int],
+    resizes: List[int],
+    sources: List[str],
+    backend: str = 'auto',
+) -> List[BenchmarkResult]:
+    generate_workspace(workspace, max(palette_sizes))
+    cache_path = workspace.joinpath('cache')
+    cases = list(product(palette_sizes, widths_emojis, resizes, sources))
+
+    results = []
+    # A fresh process per case keeps peak RSS and import costs separate
+    context = multiprocessing.get_context('spawn')
+    for case in cases:
+        shutil.rmtree(cache_path, ignore_errors=True)
+        with context.Pool(1) as pool:
+            results.append(pool.apply(run_case, (workspace, *case, backend)))
+    return results
+
+
+def case_key(result: BenchmarkResult) -> Tuple[Any, ...]:
+    # Timings from different backends are not compared with each other
+    return (
+        result['palette_size'],
+        result['width_emojis'],
+        result['resize'],
+        result['source'],
+        result.get('backend'),
+    )
+
+
+def compare_results(
+    results: List[BenchmarkResult], baseline: List[BenchmarkResult]
+) -> List[Tuple[Tuple[Any, ...], str, float, float]]:
+    baseline_cases = {case_key(result): result for result in baseline}
+    comparisons = []
+    for result in results:
+        baseline_result = baseline_cases.get(case_key(result))
+        if baseline_result is None:
+            continue
+        for stage, seconds in result['stages'].items():
+            if stage in baseline_result['stages']:
+                comparisons.append(
+                    (
+                        case_key(result),
+                        stage,
+                        seconds,
+                        baseline_result['stages'][stage],
+                    )
+                )
+    return comparisons
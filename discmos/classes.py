@@ -1,8 +1,11 @@
+import re
 from dataclasses import dataclass
-from typing import Set
+from typing import Optional, Set
 
+from .constants import Mode
 
-@dataclass(frozen=True)
+
+@dataclass(frozen=True, slots=True)
 class Emoji:
     id: int
     name: str
@@ -13,3 +16,13 @@ class Emoji:
 class EmojiData:
     servers: Set[str]
     emojis: Set[Emoji]
+
+
+@dataclass(frozen=True)
+class IncludeRule:
+    line: str
+    mode: Mode
+    server: bool
+    search: str
+    query: str
+    pattern: Optional[re.Pattern] = None
@@ -1,25 +1,176 @@
 import io
+import itertools
+import json
+import math
+import time
 import webbrowser
 from pathlib import Path
-from typing import Any, List
+from typing import Any, Callable, List, Optional, Tuple
 
 import click
 import pyclip
 import win32clipboard
 from PIL import Image
 
+from .animation import GifWriter, run_animation
+from .backend import get_backend, set_backend
 from .classes import Emoji
-from .constants import DEFAULT_INCLUDE, DISCORD_URL
-from .download import download_emojis
-from .emoji_data import emojis_from_workspace
-from .mosaic import run_composite, run_mosaic
+from .batch import find_sources, run_batch
+from .benchmark import (
+    check_benchmark_workspace,
+    compare_results,
+    run_benchmark,
+)
+from .constants import (
+    BACKENDS,
+    BATCH_WORKERS,
+    BENCHMARK_SOURCES,
+    DEFAULT_INCLUDE,
+    DISCORD_URL,
+    DOWNLOAD_WORKERS,
+    EMOJI_URL,
+    MATCHERS,
+    MEMORY_BUDGET,
+    METRICS,
+    SERVER_HOST,
+    SERVER_PORT,
+    TOP_K,
+)
+from .download import download_emojis, missing_emojis
+from .emoji_data import emojis_from_workspace, get_emoji_data
+from .emoji_store import (
+    collect_garbage,
+    import_legacy_images,
+    repair_images,
+)
+from .mosaic import (
+    composite_cell_size,
+    emojis_to_text,
+    render_composite,
+    render_contact_sheet,
+    run_mosaic,
+    run_mosaic_sweep,
+    write_composite,
+)
+from .profiling import start_profiling, stop_profiling
+from .server import MosaicHTTPServer, MosaicServer, MosaicUnixHTTPServer
 
 DOCS = {
     'workspace': 'Path to the desired workspace directory (does not have to exist)',
-    'update': 'Forcibly update emoji image files, even if they already exist',
+    'update': 'Check emojis that were already downloaded for changes (with conditional requests when possible)',
+    'verify': 'Check every stored emoji image against its hash and download damaged ones again',
 }
 
 
+MATCHING_OPTIONS = [
+    click.option(
+        '--suffix',
+        type=str,
+        default='_mosaic_{we}_{r}_{hw}_{sw}_{vw}',
+        help='Text added to the stem of the source file name to form the output file name',
+    ),
+    click.option(
+        '--hue-weight',
+        type=float,
+        default=1,
+        help='How much hue should be preserved',
+    ),
+    click.option(
+        '--saturation-weight',
+        type=float,
+        default=1,
+        help='How much saturation should be preserved',
+    ),
+    click.option(
+        '--value-weight',
+        type=float,
+        default=1,
+        help='How much value should be preserved',
+    ),
+    click.option(
+        '--memory-budget',
+        type=int,
+        default=MEMORY_BUDGET // 2**20,
+        help='Approximate memory in MiB that tile matching may use at once (lower uses less memory but may be slower)',
+    ),
+    click.option(
+        '--matcher',
+        type=click.Choice(MATCHERS),
+        default='exact',
+        help='How emojis are matched to tiles (approximate and coarse prefilter the emojis with fewer values per tile, so they are faster for large palettes but may pick slightly worse emojis and still scale linearly with the palette size; lut is fastest but needs a RESIZE of 1)',
+    ),
+    click.option(
+        '--top-k',
+        type=click.IntRange(min=1),
+        default=TOP_K,
+        help='How many candidate emojis the approximate and coarse matchers compare exactly for each tile',
+    ),
+    click.option(
+        '--metric',
+        type=click.Choice(METRICS),
+        default='l1',
+        help='How the difference between a tile and an emoji is measured (l1 sums absolute differences, l2 sums squared differences and is faster for the exact matcher)',
+    ),
+]
+
+
+def matching_options(function: Callable) -> Callable:
+    for option in reversed(MATCHING_OPTIONS):
+        function = option(function)
+    return function
+
+
+def format_suffix(
+    suffix: str,
+    width_emojis: int,
+    resize: int,
+    hue_weight: float,
+    saturation_weight: float,
+    value_weight: float,
+) -> str:
+    return suffix.format(
+        we=width_emojis,
+        r=resize,
+        hw=hue_weight,
+        sw=saturation_weight,
+        vw=value_weight,
+    )
+
+
+def parse_weight_sets(sweep: Tuple[str, ...]) -> List[Tuple[float, ...]]:
+    weight_sets = []
+    for value in sweep:
+        channels = value.split(',')
+        try:
+            channel_values = [
+                [float(weight) for weight in channel.split('/')]
+                for channel in channels
+            ]
+        except ValueError:
+            channel_values = None
+        if channel_values is None or len(channels) != 3:
+            raise click.BadParameter(
+                f'expected HUE,SATURATION,VALUE weights, got "{value}"',
+                param_hint="'--sweep'",
+            )
+        weight_sets.extend(itertools.product(*channel_values))
+    # Repeated combinations would only be matched and saved twice
+    return list(dict.fromkeys(weight_sets))
+
+
+def check_matcher(matcher: str, resize: int) -> None:
+    if matcher == 'lut' and resize != 1:
+        raise click.BadParameter(
+            'the lut matcher needs a RESIZE of 1', param_hint="'--matcher'"
+        )
+    if matcher != 'exact' and get_backend().name != 'torch':
+        raise click.BadParameter(
+            f'the {matcher} matcher needs the torch backend (install it '
+            'with "pip install discmos[torch]")',
+            param_hint="'--matcher'",
+        )
+
+
 def copy_data(clipboard_format: int, data: Any) -> None:
     try:
         win32clipboard.OpenClipboard()
@@ -30,8 +181,69 @@ def copy_data(clipboard_format: int, data: Any) -> None:
 
 
 @click.group()
-def cli() -> None:
-    pass
+@click.option(
+    '--profile',
+    type=bool,
+    default=False,
+    is_flag=True,
+    help='Whether to print the time and memory used by each stage',
+)
+@click.option(
+    '--profile-python',
+    type=bool,
+    default=False,
+    is_flag=True,
+    help='Whether to also trace the peak Python memory of each stage with tracemalloc (slows down every stage)',
+)
+@click.option(
+    '--profile-output',
+    type=click.Path(dir_okay=False, writable=True, path_type=Path),
+    default=None,
+    help='Path to save the time and memory used by each stage to',
+)
+@click.option(
+    '--profile-format',
+    type=click.Choice(['json', 'chrome']),
+    default='json',
+    help='Format of --profile-output (chrome is a trace for chrome://tracing or Perfetto)',
+)
+@click.option(
+    '--backend',
+    type=click.Choice(['auto', *BACKENDS]),
+    default='auto',
+    envvar='DISCMOS_BACKEND',
+    help='Array library used for matching (auto uses torch if it is installed and numpy otherwise)',
+)
+@click.pass_context
+def cli(
+    ctx: click.Context,
+    profile: bool,
+    profile_python: bool,
+    profile_output: Optional[Path],
+    profile_format: str,
+    backend: str,
+) -> None:
+    try:
+        set_backend(backend)
+    except ImportError as error:
+        raise click.BadParameter(
+            f'{error} (install torch with "pip install discmos[torch]")',
+            param_hint="'--backend'",
+        )
+    if not profile and profile_output is None:
+        return
+
+    profiler = start_profiling(profile_python)
+
+    def report() -> None:
+        stop_profiling()
+        if profile:
+            click.echo(profiler.summary(), err=True)
+        if profile_output is not None:
+            profiler.save(profile_output, profile_format)
+            click.echo(f'Saved profile to {profile_output}', err=True)
+
+    ctx.call_on_close(report)
 
 
 @cli.command()
@@ -52,6 +264,7 @@ def init_workspace(workspace: Path) -> None:
     sources_dir = workspace.joinpath('sources')
     output_images_dir = workspace.joinpath('output-images')
     output_text_dir = workspace.joinpath('output-text')
+    cache_dir = workspace.joinpath('cache')
     include_file = workspace.joinpath('include.txt')
     if not workspace.is_dir():
         workspace.mkdir()
@@ -63,6 +276,8 @@ def init_workspace(workspace: Path) -> None:
         output_images_dir.mkdir()
     if not output_text_dir.is_dir():
         output_text_dir.mkdir()
+    if not cache_dir.is_dir():
+        cache_dir.mkdir()
     if not include_file.is_file():
         include_file.write_text(DEFAULT_INCLUDE)
     click.echo(f'Initialized {workspace}')
@@ -98,17 +313,82 @@ def preview_include(workspace: str) -> None:
 @click.option(
     '--update', type=bool, is_flag=True, default=False, help=DOCS['update']
 )
-def download_all(workspace: Path, update: bool) -> None:
+@click.option(
+    '--verify', type=bool, is_flag=True, default=False, help=DOCS['verify']
+)
+@click.option(
+    '--emoji-url',
+    type=str,
+    default=EMOJI_URL,
+    envvar='DISCMOS_EMOJI_URL',
+    help='URL to download emojis from, where {ID} is replaced by the emoji ID',
+)
+@click.option(
+    '--workers',
+    type=int,
+    default=DOWNLOAD_WORKERS,
+    help='How many emojis are downloaded at once',
+)
+def download_all(
+    workspace: Path, update: bool, verify: bool, emoji_url: str, workers: int
+) -> None:
     '''
     Downloads all of the emojis from emoji-data.json that are included
-    in include.txt.
+    in include.txt, repairs damaged emoji images and removes emojis that
+    are no longer in emoji-data.json.
 
     WORKSPACE: Path to the desired workspace directory (does not have to exist)
-    UPDATE: Forcibly update emoji image files, even if they already exist
+    UPDATE: Check emojis that were already downloaded for changes
+    VERIFY: Check every stored emoji image against its hash
     '''
-    emojis = emojis_from_workspace(workspace)
+    if workers < 1:
+        raise click.BadParameter(
+            'must be at least 1', param_hint="'--workers'"
+        )
+    emojis_path = workspace.joinpath('emojis')
+    imported = import_legacy_images(emojis_path)
+    if imported:
+        click.echo(f'Moved {imported} emoji images into the atlas')
+    repaired = repair_images(emojis_path, verify)
+    if repaired:
+        click.echo(f'Found {repaired} damaged emoji images to download again')
+    emojis = missing_emojis(
+        emojis_from_workspace(workspace), emojis_path, update
+    )
 
-    download_emojis(emojis, workspace.joinpath('emojis'), update)
+    failures = []
+    download_stats = {}
+    results = download_emojis(
+        emojis, emojis_path, emoji_url, workers, download_stats
+    )
+    with click.progressbar(
+        results, length=len(emojis), label='Downloading emojis'
+    ) as progress:
+        for emoji, error in progress:
+            if error is not None:
+                failures.append((emoji, error))
+
+    for emoji, error in failures:
+        click.echo(
+            f'Failed to download :{emoji.name}: ({emoji.id}): {error}',
+            err=True,
+        )
+    unchanged = download_stats['unchanged']
+    click.echo(
+        f'Downloaded {len(emojis) - len(failures) - unchanged} emojis '
+        f'({unchanged} unchanged, {len(failures)} failed)'
+    )
+
+    removed, freed = collect_garbage(
+        emojis_path,
+        {emoji.id for emoji in get_emoji_data(workspace).emojis},
+    )
+    if removed:
+        click.echo(
+            f'Removed {removed} emojis that are no longer in emoji-data.json'
+        )
+    if freed:
+        click.echo(f'Removed {freed} unused emoji images from the atlas')
 
 
 @cli.command()
@@ -169,29 +449,13 @@ Steps to scrape emojis:
 @click.argument('source', type=str)
 @click.argument('width-emojis', type=int)
 @click.argument('resize', type=int)
+@matching_options
 @click.option(
-    '--suffix',
-    type=str,
-    default='_mosaic_{we}_{r}_{hw}_{sw}_{vw}',
-    help='Text added to the stem of the source file name to form the output file name',
-)
-@click.option(
-    '--hue-weight',
-    type=float,
-    default=1,
-    help='How much hue should be preserved',
-)
-@click.option(
-    '--saturation-weight',
-    type=float,
-    default=1,
-    help='How much saturation should be preserved',
-)
-@click.option(
-    '--value-weight',
-    type=float,
-    default=1,
-    help='How much value should be preserved',
+    '--stats',
+    type=bool,
+    default=False,
+    is_flag=True,
+    help='Whether to print matching statistics (for matchers other than exact, this includes recall against the exact matcher)',
 )
 @click.option(
     '--save',
@@ -207,6 +471,12 @@ Steps to scrape emojis:
     is_flag=True,
     help='Whether to display the output',
 )
+@click.option(
+    '--sweep',
+    type=str,
+    multiple=True,
+    help='Hue, saturation and value weights to make a mosaic with, as H,S,V, instead of the weight options; each weight may list several values separated by / to make a mosaic for every combination (for example 1/2/4,1,1/2), and the option can be repeated',
+)
 @click.pass_context
 def mosaic(
     ctx: click.Context,
@@ -218,8 +488,14 @@ def mosaic(
     hue_weight: float,
     saturation_weight: float,
     value_weight: float,
+    memory_budget: int,
+    matcher: str,
+    top_k: int,
+    metric: str,
+    stats: bool,
     save: bool,
     show: bool,
+    sweep: Tuple[str, ...],
 ) -> None:
     '''
     Runs the mosaic algorithm.
@@ -229,33 +505,81 @@ def mosaic(
     WIDTH-EMOJIS: The width of the final mosaic in emojis (not pixels, lower is faster; start with 10 to 80)
     RESIZE: The width and height that each tile is resized to before computation (lower is faster and uses less memory; start with 4 to 16)
     '''
+    check_matcher(matcher, resize)
+    weight_sets = parse_weight_sets(sweep)
+    if weight_sets and matcher != 'exact':
+        raise click.BadParameter(
+            'a sweep needs the exact matcher', param_hint="'--sweep'"
+        )
     emojis = emojis_from_workspace(workspace)
 
-    output_emojis = run_mosaic(
-        emojis,
-        workspace.joinpath('emojis'),
-        workspace.joinpath('sources', source),
-        width_emojis,
-        (resize, resize),
-        Image.LANCZOS,
-        hue_weight,
-        saturation_weight,
-        value_weight,
-    )
+    mosaic_stats = {} if stats else None
+    if weight_sets:
+        outputs = run_mosaic_sweep(
+            emojis,
+            workspace.joinpath('emojis'),
+            workspace.joinpath('sources', source),
+            width_emojis,
+            (resize, resize),
+            Image.LANCZOS,
+            weight_sets,
+            memory_budget * 2**20,
+            workspace.joinpath('cache'),
+            metric,
+            mosaic_stats,
+        )
+    else:
+        weight_sets = [(hue_weight, saturation_weight, value_weight)]
+        outputs = [
+            run_mosaic(
+                emojis,
+                workspace.joinpath('emojis'),
+                workspace.joinpath('sources', source),
+                width_emojis,
+                (resize, resize),
+                Image.LANCZOS,
+                hue_weight,
+                saturation_weight,
+                value_weight,
+                memory_budget * 2**20,
+                workspace.joinpath('cache'),
+                matcher,
+                top_k,
+                metric,
+                mosaic_stats,
+            )
+        ]
+
+    if stats:
+        for name, value in mosaic_stats.items():
+            click.echo(f'{name}: {value:.4g}')
 
     ctx.ensure_object(dict)
-    ctx.obj['emojis'] = output_emojis
+    ctx.obj['emojis'] = outputs[0]
     ctx.obj['workspace'] = workspace
     ctx.obj['source'] = source
-    ctx.obj['suffix'] = suffix.format(
-        we=width_emojis,
-        r=resize,
-        hw=hue_weight,
-        sw=saturation_weight,
-        vw=value_weight,
+    ctx.obj['suffix'] = format_suffix(
+        suffix,
+        width_emojis,
+        resize,
+        hue_weight,
+        saturation_weight,
+        value_weight,
     )
     ctx.obj['save'] = save
     ctx.obj['show'] = show
+    ctx.obj['sweep'] = None
+    if sweep:
+        ctx.obj['sweep'] = [
+            (
+                f'hue {weights[0]:g}, saturation {weights[1]:g}, '
+                f'value {weights[2]:g}',
+                format_suffix(suffix, width_emojis, resize, *weights),
+                output_emojis,
+            )
+            for weights, output_emojis in zip(weight_sets, outputs)
+        ]
+        ctx.obj['sheet_suffix'] = f'_sweep_{width_emojis}_{resize}'
 
 
 @mosaic.command()
@@ -270,13 +594,25 @@ def text(ctx: click.Context) -> None:
     suffix: str = ctx.obj['suffix']
     save: bool = ctx.obj['save']
     show: bool = ctx.obj['show']
+    sweep: Optional[List[Tuple[str, str, List[List[Emoji]]]]] = ctx.obj[
+        'sweep'
+    ]
 
-    output_text = ''
-    for row in output_emojis:
-        for emoji in row:
-            output_text += f':{emoji.name}: '
-        output_text.removesuffix(' ')
-        output_text += '\n'
+    if sweep is not None:
+        # Only one mosaic fits the clipboard, so every mosaic of a sweep is
+        # saved instead
+        for label, sweep_suffix, sweep_emojis in sweep:
+            save_path = workspace.joinpath(
+                'output-text', f'{Path(source).stem}{sweep_suffix}.txt'
+            )
+            output_text = emojis_to_text(sweep_emojis)
+            save_path.write_text(output_text)
+            click.echo(f'Saved {label} to {save_path}')
+            if show:
+                click.echo(output_text)
+        return
+
+    output_text = emojis_to_text(output_emojis)
 
     pyclip.copy(output_text)
     click.echo('Copied emojis to clipboard')
@@ -295,8 +631,15 @@ def text(ctx: click.Context) -> None:
 
 @mosaic.command()
 @click.argument('resize-width', type=int)
+@click.option(
+    '--stream',
+    type=bool,
+    default=False,
+    is_flag=True,
+    help='Whether to write the image to <workspace>/output-images one row of emojis at a time instead of copying or showing it (for mosaics too large to fit in memory; the width is rounded up to a whole number of pixels per emoji)',
+)
 @click.pass_context
-def composite(ctx: click.Context, resize_width: int) -> None:
+def composite(ctx: click.Context, resize_width: int, stream: bool) -> None:
     '''
     Show and save a composite image of how the emojis would be rendered
     (useful to get around the Discord character limit).
@@ -309,11 +652,72 @@ def composite(ctx: click.Context, resize_width: int) -> None:
     suffix: str = ctx.obj['suffix']
     save: bool = ctx.obj['save']
     show: bool = ctx.obj['show']
+    sweep: Optional[List[Tuple[str, str, List[List[Emoji]]]]] = ctx.obj[
+        'sweep'
+    ]
 
-    image = run_composite(output_emojis, workspace.joinpath('emojis'))
-    image = image.resize(
-        (resize_width, round(image.height / image.width * resize_width)),
-        Image.LANCZOS,
+    if sweep is not None:
+        images = []
+        for label, sweep_suffix, sweep_emojis in sweep:
+            save_path = workspace.joinpath(
+                'output-images', f'{Path(source).stem}{sweep_suffix}.png'
+            )
+            if stream:
+                with open(save_path, 'wb') as file:
+                    write_composite(
+                        sweep_emojis,
+                        workspace.joinpath('emojis'),
+                        file,
+                        composite_cell_size(
+                            len(sweep_emojis[0]), resize_width
+                        ),
+                    )
+            else:
+                image = render_composite(
+                    sweep_emojis, workspace.joinpath('emojis'), resize_width
+                )
+                image.save(save_path)
+                images.append(image)
+            click.echo(f'Saved {label} to {save_path}')
+        if stream:
+            return
+
+        sheet = render_contact_sheet(
+            images,
+            [label for label, _, _ in sweep],
+            math.ceil(math.sqrt(len(images))),
+        )
+        sheet_path = workspace.joinpath(
+            'output-images',
+            f'{Path(source).stem}{ctx.obj["sheet_suffix"]}.png',
+        )
+        sheet.save(sheet_path)
+        image_bytes = io.BytesIO()
+        sheet.save(image_bytes, 'DIB')
+        copy_data(win32clipboard.CF_DIB, image_bytes.getvalue())
+        click.echo(f'Saved contact sheet to {sheet_path} and copied it')
+        if show:
+            sheet.show()
+        return
+
+    if stream:
+        save_path = workspace.joinpath(
+            'output-images', f'{Path(source).stem}{suffix}.png'
+        )
+        with open(save_path, 'wb') as file:
+            size = write_composite(
+                output_emojis,
+                workspace.joinpath('emojis'),
+                file,
+                composite_cell_size(len(output_emojis[0]), resize_width),
+            )
+        click.echo(
+            f'Saved emojis to {save_path} ({size[0]}x{size[1]} pixels)'
+        )
+        return
+
+    image = render_composite(
+        output_emojis, workspace.joinpath('emojis'), resize_width
     )
 
     image_bytes = io.BytesIO()
@@ -331,3 +735,401 @@ def composite(ctx: click.Context, resize_width: int) -> None:
 
     if show:
         image.show()
+
+
+@cli.command()
+@click.argument(
+    'workspace',
+    type=click.Path(
+        file_okay=False, writable=True, resolve_path=True, path_type=Path
+    ),
+)
+@click.argument('pattern', type=str)
+@click.argument('width-emojis', type=int)
+@click.argument('resize', type=int)
+@click.argument('output', type=click.Choice(['text', 'composite']))
+@matching_options
+@click.option(
+    '--resize-width',
+    type=int,
+    default=1000,
+    help='Width in pixels to resize composite images to',
+)
+@click.option(
+    '--workers',
+    type=int,
+    default=BATCH_WORKERS,
+    help='How many source images are decoded in parallel with matching',
+)
+def batch(
+    workspace: Path,
+    pattern: str,
+    width_emojis: int,
+    resize: int,
+    output: str,
+    suffix: str,
+    hue_weight: float,
+    saturation_weight: float,
+    value_weight: float,
+    memory_budget: int,
+    matcher: str,
+    top_k: int,
+    metric: str,
+    resize_width: int,
+    workers: int,
+) -> None:
+    '''
+    Runs the mosaic algorithm on many source images, loading the emojis
+    once, and saves each output to a file.
+
+    WORKSPACE: Path to the desired workspace directory (does not have to exist)
+    PATTERN: A directory or glob pattern of source files in <workspace>/sources/
+    WIDTH-EMOJIS: The width of the final mosaics in emojis
+    RESIZE: The width and height that each tile is resized to before computation
+    OUTPUT: Whether to save text or composite images
+    '''
+    check_matcher(matcher, resize)
+    if workers < 1:
+        raise click.BadParameter(
+            'must be at least 1', param_hint="'--workers'"
+        )
+    source_paths = find_sources(workspace.joinpath('sources'), pattern)
+    if not source_paths:
+        raise click.ClickException(f'No source files match "{pattern}"')
+
+    start_time = time.perf_counter()
+    emojis = emojis_from_workspace(workspace)
+    suffix = format_suffix(
+        suffix,
+        width_emojis,
+        resize,
+        hue_weight,
+        saturation_weight,
+        value_weight,
+    )
+
+    results = run_batch(
+        emojis,
+        workspace.joinpath('emojis'),
+        source_paths,
+        width_emojis,
+        (resize, resize),
+        Image.LANCZOS,
+        hue_weight,
+        saturation_weight,
+        value_weight,
+        memory_budget * 2**20,
+        workspace.joinpath('cache'),
+        matcher,
+        top_k,
+        metric,
+        workers,
+    )
+    for source_path, output_emojis, load_seconds, match_seconds in results:
+        output_start_time = time.perf_counter()
+        if output == 'text':
+            save_path = workspace.joinpath(
+                'output-text', f'{source_path.stem}{suffix}.txt'
+            )
+            save_path.write_text(emojis_to_text(output_emojis))
+        else:
+            save_path = workspace.joinpath(
+                'output-images', f'{source_path.stem}{suffix}.png'
+            )
+            image = render_composite(
+                output_emojis, workspace.joinpath('emojis'), resize_width
+            )
+            image.save(save_path)
+        output_seconds = time.perf_counter() - output_start_time
+
+        click.echo(
+            f'Saved {save_path} (load {load_seconds:.2f}s, '
+            f'match {match_seconds:.2f}s, output {output_seconds:.2f}s)'
+        )
+
+    total_seconds = time.perf_counter() - start_time
+    click.echo(
+        f'Processed {len(source_paths)} images in {total_seconds:.2f}s '
+        f'({len(source_paths) / total_seconds:.2f} images/s)'
+    )
+
+
+@cli.command()
+@click.argument(
+    'workspace',
+    type=click.Path(
+        file_okay=False, writable=True, resolve_path=True, path_type=Path
+    ),
+)
+@click.argument('source', type=str)
+@click.argument('width-emojis', type=int)
+@click.argument('resize', type=int)
+@matching_options
+@click.option(
+    '--resize-width',
+    type=int,
+    default=1000,
+    help='Approximate width in pixels of the composite animation',
+)
+@click.option(
+    '--reuse-threshold',
+    type=float,
+    default=0,
+    help='How much a tile may change (average weighted difference per pixel) before its emoji is matched again (0 only reuses emojis for unchanged tiles)',
+)
+@click.option(
+    '--stats',
+    type=bool,
+    default=False,
+    is_flag=True,
+    help='Whether to print matching statistics',
+)
+def animate(
+    workspace: Path,
+    source: str,
+    width_emojis: int,
+    resize: int,
+    suffix: str,
+    hue_weight: float,
+    saturation_weight: float,
+    value_weight: float,
+    memory_budget: int,
+    matcher: str,
+    top_k: int,
+    metric: str,
+    resize_width: int,
+    reuse_threshold: float,
+    stats: bool,
+) -> None:
+    '''
+    Runs the mosaic algorithm on every frame of an animated GIF or PNG
+    and saves an animated composite GIF.
+
+    WORKSPACE: Path to the desired workspace directory (does not have to exist)
+    SOURCE: The name of the source file in <workspace>/sources/
+    WIDTH-EMOJIS: The width of the final mosaic in emojis
+    RESIZE: The width and height that each tile is resized to before computation
+    '''
+    check_matcher(matcher, resize)
+    emojis = emojis_from_workspace(workspace)
+    suffix = format_suffix(
+        suffix,
+        width_emojis,
+        resize,
+        hue_weight,
+        saturation_weight,
+        value_weight,
+    )
+
+    animation_stats = {} if stats else None
+    frames = run_animation(
+        emojis,
+        workspace.joinpath('emojis'),
+        workspace.joinpath('sources', source),
+        width_emojis,
+        (resize, resize),
+        Image.LANCZOS,
+        hue_weight,
+        saturation_weight,
+        value_weight,
+        memory_budget * 2**20,
+        workspace.joinpath('cache'),
+        matcher,
+        top_k,
+        metric,
+        reuse_threshold,
+        animation_stats,
+    )
+    save_path = workspace.joinpath(
+        'output-images', f'{Path(source).stem}{suffix}.gif'
+    )
+    with open(save_path, 'wb') as file:
+        writer = GifWriter(
+            file,
+            workspace.joinpath('emojis'),
+            composite_cell_size(width_emojis, resize_width),
+        )
+        for output_emojis, duration in frames:
+            writer.write_frame(output_emojis, duration)
+        writer.close()
+
+    if stats:
+        for name, value in animation_stats.items():
+            click.echo(f'{name}: {value:.4g}')
+    click.echo(f'Saved animation to {save_path}')
+
+
+@cli.command()
+@click.argument(
+    'workspace',
+    type=click.Path(
+        file_okay=False, writable=True, resolve_path=True, path_type=Path
+    ),
+)
+@click.option(
+    '--palette-size',
+    type=int,
+    multiple=True,
+    default=(500, 2000),
+    help='Number of emojis in the palette (can be repeated)',
+)
+@click.option(
+    '--width-emojis',
+    type=int,
+    multiple=True,
+    default=(40, 100),
+    help='Width of the mosaic in emojis (can be repeated)',
+)
+@click.option(
+    '--resize',
+    type=int,
+    multiple=True,
+    default=(4, 8),
+    help='Width and height that tiles are resized to (can be repeated)',
+)
+@click.option(
+    '--source',
+    type=click.Choice(list(BENCHMARK_SOURCES)),
+    multiple=True,
+    default=tuple(BENCHMARK_SOURCES),
+    help='Synthetic source image to use (can be repeated)',
+)
+@click.option(
+    '--output',
+    type=click.Path(dir_okay=False, writable=True, path_type=Path),
+    default=None,
+    help='Path to save the results to as JSON',
+)
+@click.option(
+    '--baseline',
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+    default=None,
+    help='Path to previously saved results to compare against',
+)
+def benchmark(
+    workspace: Path,
+    palette_size: Tuple[int, ...],
+    width_emojis: Tuple[int, ...],
+    resize: Tuple[int, ...],
+    source: Tuple[str, ...],
+    output: Optional[Path],
+    baseline: Optional[Path],
+) -> None:
+    '''
+    Times each stage of the mosaic pipeline on a synthetic workspace,
+    sweeping over palette sizes, mosaic widths and tile sizes.
+
+    WORKSPACE: Path to the synthetic workspace directory (generated if it does not exist; do not use a real workspace)
+    '''
+    try:
+        check_benchmark_workspace(workspace)
+    except ValueError as error:
+        raise click.BadParameter(str(error), param_hint="'WORKSPACE'")
+    results = run_benchmark(
+        workspace,
+        list(palette_size),
+        list(width_emojis),
+        list(resize),
+        list(source),
+        get_backend().name,
+    )
+
+    for result in results:
+        peak_rss = result['peak_rss']
+        click.echo(
+            f'palette {result["palette_size"]}, width {result["width_emojis"]}, '
+            f'resize {result["resize"]}, source {result["source"]} '
+            f'({result["tiles"]} tiles)'
+            + (
+                ''
+                if peak_rss is None
+                else f', peak RSS {peak_rss / 2**20:.0f} MiB'
+            )
+        )
+        for stage, seconds in result['stages'].items():
+            click.echo(f'    {stage}: {seconds:.4f}s')
+
+    if output is not None:
+        output.write_text(json.dumps(results, indent=2))
+        click.echo(f'Saved results to {output}')
+
+    if baseline is not None:
+        click.echo(f'Compared to {baseline}:')
+        comparisons = compare_results(
+            results, json.loads(baseline.read_text())
+        )
+        if not comparisons:
+            click.echo(
+                '    No cases with the same palette size, width, resize, '
+                'source and backend'
+            )
+        for case, stage, seconds, baseline_seconds in comparisons:
+            click.echo(
+                f'    {case} {stage}: {seconds:.4f}s vs '
+                f'{baseline_seconds:.4f}s '
+                f'({seconds / max(baseline_seconds, 1e-9):.2f}x)'
+            )
+
+
+@cli.command()
+@click.argument(
+    'workspace',
+    type=click.Path(
+        file_okay=False, writable=True, resolve_path=True, path_type=Path
+    ),
+)
+@click.option(
+    '--host',
+    type=str,
+    default=SERVER_HOST,
+    help='Host to listen on',
+)
+@click.option(
+    '--port',
+    type=int,
+    default=SERVER_PORT,
+    help='Port to listen on',
+)
+@click.option(
+    '--socket',
+    'socket_path',
+    type=click.Path(dir_okay=False, path_type=Path),
+    default=None,
+    help='Path of a Unix socket to listen on instead of a host and port',
+)
+@click.option(
+    '--memory-budget',
+    type=int,
+    default=MEMORY_BUDGET // 2**20,
+    help='Approximate memory in MiB that tile matching may use at once',
+)
+def serve(
+    workspace: Path,
+    host: str,
+    port: int,
+    socket_path: Optional[Path],
+    memory_budget: int,
+) -> None:
+    '''
+    Keeps the emojis loaded and serves mosaics over HTTP. POST a source
+    image to /mosaic?width=<width-emojis>&resize=<resize> (optionally with
+    hue_weight, saturation_weight, value_weight, format=text|png and
+    image_width) to get the emoji text or a composite PNG. Changes to
+    include.txt, emoji-data.json and the emojis directory are picked up
+    automatically.
+
+    WORKSPACE: Path to the desired workspace directory (does not have to exist)
+    '''
+    mosaic_server = MosaicServer(workspace, memory_budget * 2**20)
+    if socket_path is None:
+        http_server = MosaicHTTPServer((host, port), mosaic_server)
+        click.echo(f'Serving mosaics on http://{host}:{port}/mosaic')
+    else:
+        http_server = MosaicUnixHTTPServer(socket_path, mosaic_server)
+        click.echo(f'Serving mosaics on {socket_path}')
+
+    with http_server:
+        try:
+            http_server.serve_forever()
+        except KeyboardInterrupt:
+            pass
@@ -6,6 +6,7 @@ PREFIXES = {'include': '+ ', 'exclude': '- ', 'emoji': '    '}
 ALL_SEARCH = re.compile(r'(?<=^)all(?=( *// .*)?$)')
 SPECIFIC_SEARCH = re.compile(r'(?<=^").*(?="( *// .*)?$)')
 REGEX_SEARCH = re.compile(r'(?<=^/).*(?=/( *// .*)?$)')
+INCLUDE_CACHE_SIZE = 16
 
 DEFAULT_INCLUDE = '''+ all
 // Replace with "- all" to include no emojis by default
@@ -16,8 +17,44 @@ EMOJI_URL = (
     'https://cdn.discordapp.com/emojis/{ID}.webp?size=96&quality=lossless'
 )
 EMOJI_FILE = '{ID}.png'
+STORE_FILE = '{hash}.png'
+STORE_INDEX_FILE = 'index.json'
+ATLAS_FILE = 'atlas.bin'
+ATLAS_GENERATION_FILE = 'atlas.{generation}.bin'
+ATLAS_INDEX_FILE = 'atlas.json'
+MANIFEST_FILE = 'manifest.json'
+DOWNLOAD_WORKERS = 16
+DOWNLOAD_RETRIES = 5
+DOWNLOAD_TIMEOUT = 30
+DOWNLOAD_BACKOFF = 1
+EMOJI_DATA_CACHE_FILE = 'emoji-data.pickle'
+FEATURES_FILE = 'features_{w}x{h}_{resample}.npy'
+FEATURES_INDEX_FILE = 'features_{w}x{h}_{resample}.json'
+PREFILTER_FILE = 'prefilter_{w}x{h}_{resample}.pt'
+LUT_FILE = 'lut_{levels}_{metric}_{resample}.pt'
+SOURCE_TILES_FILE = 'source_{key}.npy'
+MATCH_STATE_FILE = 'match_{key}.npz'
 
 SIZE = (96, 96)
 BACKGROUND_COLOR = (49, 51, 56)
 
+MEMORY_BUDGET = 512 * 2**20
+BACKENDS = ('torch', 'numpy')
+MATCHERS = ('exact', 'approximate', 'coarse', 'lut')
+METRICS = ('l1', 'l2')
+TOP_K = 16
+PREFILTER_DIMENSIONS = 16
+LUT_LEVELS = 64
+BATCH_WORKERS = 4
+FRAME_DURATION = 100
+CONTACT_SHEET_MARGIN = 8
+
+SERVER_HOST = '127.0.0.1'
+SERVER_PORT = 8765
+SERVER_BATCH_WINDOW = 0.01
+
+BENCHMARK_SOURCES = {'small': (640, 480), 'large': (1920, 1080)}
+BENCHMARK_COMPOSITE_WIDTH = 1000
+BENCHMARK_MARKER_FILE = '.discmos-benchmark'
+
 DISCORD_URL = 'https://discord.com/app'
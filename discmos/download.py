@@ -1,20 +1,70 @@
 import io
-import multiprocessing
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import List
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
+import numpy as np
 import requests
 from PIL import Image
+from requests.adapters import HTTPAdapter
 
 from .classes import Emoji
-from .constants import BACKGROUND_COLOR, EMOJI_FILE, EMOJI_URL, SIZE
+from .constants import (
+    BACKGROUND_COLOR,
+    DOWNLOAD_BACKOFF,
+    DOWNLOAD_RETRIES,
+    DOWNLOAD_TIMEOUT,
+    DOWNLOAD_WORKERS,
+    EMOJI_URL,
+    SIZE,
+)
+from .emoji_store import EmojiAtlas
 
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def create_session(workers: int = DOWNLOAD_WORKERS) -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def retry_delay(response: Optional[requests.Response], attempt: int) -> float:
+    if response is not None and 'Retry-After' in response.headers:
+        try:
+            return max(0.0, float(response.headers['Retry-After']))
+        except ValueError:
+            pass
+    return DOWNLOAD_BACKOFF * 2**attempt
 
-def download_url(url: str, path: Path) -> None:
-    response = requests.get(url)
-    transparent_image = Image.open(io.BytesIO(response.content)).convert(
-        'RGBA'
-    )
+
+def fetch(
+    session: requests.Session,
+    url: str,
+    headers: Optional[Dict[str, str]] = None,
+) -> requests.Response:
+    for attempt in range(DOWNLOAD_RETRIES + 1):
+        response = None
+        try:
+            response = session.get(
+                url, headers=headers, timeout=DOWNLOAD_TIMEOUT
+            )
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == DOWNLOAD_RETRIES:
+                raise
+        else:
+            retry = response.status_code in RETRY_STATUS_CODES
+            if not retry or attempt == DOWNLOAD_RETRIES:
+                response.raise_for_status()
+                return response
+        time.sleep(retry_delay(response, attempt))
+
+
+def normalize_emoji(content: bytes) -> np.ndarray:
+    transparent_image = Image.open(io.BytesIO(content)).convert('RGBA')
 
     image_partial = Image.new('RGBA', transparent_image.size, BACKGROUND_COLOR)
     image_partial.alpha_composite(transparent_image)
@@ -26,26 +76,85 @@ def download_url(url: str, path: Path) -> None:
     )
     image.paste(image_partial, paste_position)
 
-    image.save(path)
+    return np.asarray(image)
 
 
-def download_emojis(
+def download_changed(
+    session: requests.Session, url: str, record: Optional[Dict[str, Any]]
+) -> Tuple[Optional[np.ndarray], Dict[str, Any]]:
+    # With the validators of the last download, an unchanged emoji is
+    # answered with 304 Not Modified and no image
+    headers = {}
+    if record is not None and 'etag' in record:
+        headers['If-None-Match'] = record['etag']
+    if record is not None and 'last_modified' in record:
+        headers['If-Modified-Since'] = record['last_modified']
+    response = fetch(session, url, headers)
+    if response.status_code == 304:
+        return None, record
+
+    record = {'size': len(response.content)}
+    if 'ETag' in response.headers:
+        record['etag'] = response.headers['ETag']
+    if 'Last-Modified' in response.headers:
+        record['last_modified'] = response.headers['Last-Modified']
+    return normalize_emoji(response.content), record
+
+
+def missing_emojis(
     emojis: List[Emoji], directory: Path, update: bool
-) -> None:
-    if not update:
-        downloaded = set(directory.iterdir())
-        emojis = list(
-            filter(
-                lambda emoji: EMOJI_FILE.format(ID=emoji.id) not in downloaded,
-                emojis,
-            )
-        )
-    download_arguments = (
-        (
-            EMOJI_URL.format(ID=emoji.id),
-            directory.joinpath(EMOJI_FILE.format(ID=emoji.id)),
+) -> List[Emoji]:
+    if update:
+        return emojis
+    atlas = EmojiAtlas(directory)
+    return [emoji for emoji in emojis if not atlas.contains(emoji)]
+
+
+def download_emojis(
+    emojis: List[Emoji],
+    directory: Path,
+    emoji_url: str = EMOJI_URL,
+    workers: int = DOWNLOAD_WORKERS,
+    stats: Optional[Dict[str, int]] = None,
+) -> Iterator[Tuple[Emoji, Optional[Exception]]]:
+    atlas = EmojiAtlas(directory)
+    # Only emojis whose image is still in the atlas can be left unchanged,
+    # so the others are downloaded unconditionally
+    records = {
+        emoji: (
+            atlas.manifest.get(str(emoji.id))
+            if atlas.slot(emoji) is not None
+            else None
         )
         for emoji in emojis
-    )
-    with multiprocessing.Pool() as pool:
-        pool.starmap(download_url, download_arguments)
+    }
+    unchanged_count = 0
+    session = create_session(workers)
+    with session, ThreadPoolExecutor(workers) as executor:
+        futures = {
+            executor.submit(
+                download_changed,
+                session,
+                emoji_url.format(ID=emoji.id),
+                records[emoji],
+            ): emoji
+            for emoji in emojis
+        }
+        # The atlas is only appended to from this thread, and its indexes
+        # are also saved when the download is interrupted so finished
+        # images are not fetched again
+        try:
+            for future in as_completed(futures):
+                emoji = futures[future]
+                if future.exception() is None:
+                    pixels, record = future.result()
+                    if pixels is None:
+                        unchanged_count += 1
+                    else:
+                        record['hash'] = atlas.add(emoji.id, pixels)
+                        atlas.manifest[str(emoji.id)] = record
+                yield emoji, future.exception()
+        finally:
+            atlas.save()
+            if stats is not None:
+                stats['unchanged'] = unchanged_count
@@ -1,20 +1,75 @@
 import json
+import pickle
+from array import array
 from pathlib import Path
-from typing import List
-
-import dacite
+from typing import Any, Dict, List
 
 from .classes import Emoji, EmojiData
+from .constants import EMOJI_DATA_CACHE_FILE
+from .files import atomic_write
 from .filter_emojis import filter_emojis
+from .profiling import profiled
 
 
-def get_emoji_data(workspace: Path) -> EmojiData:
-    emoji_data_text = workspace.joinpath('emoji-data.json').read_text()
+def columns_from_json(emoji_data_text: str) -> Dict[str, Any]:
     emoji_data_dict = json.loads(emoji_data_text)
-    emoji_data = dacite.from_dict(
-        EmojiData, emoji_data_dict, dacite.Config(cast=[set, int])
+    emojis = emoji_data_dict['emojis']
+    server_names = sorted(
+        set(emoji_data_dict['servers']).union(
+            emoji['server'] for emoji in emojis
+        )
+    )
+    server_indices = {name: index for index, name in enumerate(server_names)}
+    return {
+        'server_names': server_names,
+        'servers': array(
+            'I',
+            (server_indices[name] for name in set(emoji_data_dict['servers'])),
+        ),
+        'ids': array('Q', (int(emoji['id']) for emoji in emojis)),
+        'names': [emoji['name'] for emoji in emojis],
+        'emoji_servers': array(
+            'I', (server_indices[emoji['server']] for emoji in emojis)
+        ),
+    }
+
+
+def emoji_data_from_columns(columns: Dict[str, Any]) -> EmojiData:
+    server_names = columns['server_names']
+    return EmojiData(
+        {server_names[index] for index in columns['servers']},
+        set(
+            map(
+                Emoji,
+                columns['ids'],
+                columns['names'],
+                (server_names[index] for index in columns['emoji_servers']),
+            )
+        ),
     )
-    return emoji_data
+
+
+@profiled('load_emoji_data')
+def get_emoji_data(workspace: Path) -> EmojiData:
+    emoji_data_path = workspace.joinpath('emoji-data.json')
+    cache_path = workspace.joinpath('cache', EMOJI_DATA_CACHE_FILE)
+    stat = emoji_data_path.stat()
+    key = [stat.st_mtime_ns, stat.st_size]
+
+    if cache_path.is_file():
+        with open(cache_path, 'rb') as file:
+            cached = pickle.load(file)
+        if cached['key'] == key:
+            return emoji_data_from_columns(cached['columns'])
+
+    columns = columns_from_json(emoji_data_path.read_text())
+    cache_path.parent.mkdir(exist_ok=True)
+    with atomic_write(cache_path) as temp_path:
+        with open(temp_path, 'wb') as file:
+            pickle.dump(
+                {'key': key, 'columns': columns}, file, pickle.HIGHEST_PROTOCOL
+            )
+    return emoji_data_from_columns(columns)
 
 
 def emojis_from_workspace(workspace: Path) -> List[Emoji]:
@@ -0,0 +1,329 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import numpy as np
+from PIL import Image
+
+from .classes import Emoji
+from .constants import (
+    ATLAS_FILE,
+    ATLAS_GENERATION_FILE,
+    ATLAS_INDEX_FILE,
+    EMOJI_FILE,
+    MANIFEST_FILE,
+    SIZE,
+    STORE_FILE,
+    STORE_INDEX_FILE,
+)
+from .files import atomic_write
+
+LEGACY_SUFFIX = EMOJI_FILE.format(ID='')
+IMAGE_BYTES = SIZE[0] * SIZE[1] * 3
+
+
+def image_hash(pixels: np.ndarray) -> str:
+    # Hashing the normalized pixels rather than the downloaded bytes also
+    # catches the same image uploaded with a different encoding
+    digest = hashlib.sha1(f'RGB {SIZE}'.encode())
+    digest.update(np.ascontiguousarray(pixels).tobytes())
+    return digest.hexdigest()
+
+
+def read_json(path: Path) -> Dict:
+    if not path.is_file():
+        return {}
+    return json.loads(path.read_text())
+
+
+def write_json(path: Path, data: Dict) -> None:
+    with atomic_write(path) as temp_path:
+        temp_path.write_text(json.dumps(data, sort_keys=True))
+
+
+def atlas_path(directory: Path, generation: int) -> Path:
+    # Compacting writes a new generation of the atlas next to the old one
+    if generation == 0:
+        return directory.joinpath(ATLAS_FILE)
+    return directory.joinpath(
+        ATLAS_GENERATION_FILE.format(generation=generation)
+    )
+
+
+class EmojiAtlas:
+    '''
+    All emoji images of a workspace in one memory-mapped uint8 array of
+    shape (slot, height, width, channel), with every distinct image
+    stored once. index.json maps emoji IDs to image hashes, atlas.json
+    names the current generation of the atlas and maps image hashes to
+    slots, and manifest.json keeps what was downloaded for each emoji ID
+    (byte size, image hash and HTTP validators).
+    '''
+
+    def __init__(self, directory: Path) -> None:
+        self.directory = directory
+        self.ids: Dict[str, str] = read_json(
+            directory.joinpath(STORE_INDEX_FILE)
+        )
+        atlas_index = read_json(directory.joinpath(ATLAS_INDEX_FILE))
+        # Older versions only kept the slots, of generation 0
+        if 'slots' not in atlas_index:
+            atlas_index = {'generation': 0, 'slots': atlas_index}
+        self.generation: int = atlas_index['generation']
+        self.slots: Dict[str, int] = atlas_index['slots']
+        self.atlas_path = atlas_path(directory, self.generation)
+        self.manifest: Dict[str, Dict[str, Any]] = read_json(
+            directory.joinpath(MANIFEST_FILE)
+        )
+        # Slots of removed images stay unused until the atlas is compacted
+        self.slot_count = max(self.slots.values(), default=-1) + 1
+        self.mapped_images: Optional[np.ndarray] = None
+
+    @property
+    def images(self) -> np.ndarray:
+        # Mapped lazily, and again after images were appended
+        if (
+            self.mapped_images is None
+            or len(self.mapped_images) < self.slot_count
+        ):
+            shape = (self.slot_count, SIZE[1], SIZE[0], 3)
+            if not self.slots:
+                self.mapped_images = np.empty(shape, dtype=np.uint8)
+            else:
+                atlas_size = (
+                    self.atlas_path.stat().st_size
+                    if self.atlas_path.is_file()
+                    else 0
+                )
+                if atlas_size < self.slot_count * IMAGE_BYTES:
+                    raise ValueError(
+                        f'{self.atlas_path} is missing '
+                        f'{self.slot_count - atlas_size // IMAGE_BYTES} '
+                        'emoji images, run "discmos download-all" to '
+                        'repair it'
+                    )
+                self.mapped_images = np.memmap(
+                    self.atlas_path, dtype=np.uint8, mode='r', shape=shape
+                )
+        return self.mapped_images
+
+    def slot(self, emoji: Emoji) -> Optional[int]:
+        return self.slots.get(self.ids.get(str(emoji.id)))
+
+    def legacy_path(self, emoji: Emoji) -> Path:
+        content_hash = self.ids.get(str(emoji.id))
+        if content_hash is None:
+            return self.directory.joinpath(EMOJI_FILE.format(ID=emoji.id))
+        return self.directory.joinpath(STORE_FILE.format(hash=content_hash))
+
+    def key(self, emoji: Emoji) -> str:
+        # Identifies the image of an emoji, so that emojis with the same
+        # image share features and collapse into one palette entry
+        if self.slot(emoji) is not None:
+            return self.ids[str(emoji.id)]
+        return self.legacy_path(emoji).stem
+
+    def stamp(self, emoji: Emoji) -> List[int]:
+        # Images in the atlas never change, but image files may
+        if self.slot(emoji) is not None:
+            return []
+        stat = self.legacy_path(emoji).stat()
+        return [stat.st_mtime_ns, stat.st_size]
+
+    def contains(self, emoji: Emoji) -> bool:
+        return (
+            self.slot(emoji) is not None or self.legacy_path(emoji).is_file()
+        )
+
+    def image(self, emoji: Emoji) -> np.ndarray:
+        slot = self.slot(emoji)
+        if slot is not None:
+            # A view into the mapped atlas, so nothing is decoded or copied
+            return self.images[slot]
+        # Workspaces downloaded by older versions keep one file per image
+        with Image.open(self.legacy_path(emoji)) as image:
+            return np.asarray(image.convert('RGB'))
+
+    def add(self, emoji_id: int, pixels: np.ndarray) -> str:
+        content_hash = image_hash(pixels)
+        if content_hash not in self.slots:
+            # The indexes are written after the atlas, so images appended
+            # by an interrupted download are unused and overwritten here
+            slot = self.slot_count
+            with open(self.atlas_path, 'ab') as file:
+                file.truncate(slot * pixels.nbytes)
+                file.write(np.ascontiguousarray(pixels).tobytes())
+            self.slots[content_hash] = slot
+            self.slot_count += 1
+        self.ids[str(emoji_id)] = content_hash
+        return content_hash
+
+    def damaged_images(self, verify: bool = False) -> Set[str]:
+        # A truncated atlas is found from its size alone, while verify
+        # hashes every image again to also find corrupted bytes
+        atlas_size = (
+            self.atlas_path.stat().st_size if self.atlas_path.is_file() else 0
+        )
+        intact_count = atlas_size // IMAGE_BYTES
+        damaged = {
+            content_hash
+            for content_hash, slot in self.slots.items()
+            if slot >= intact_count
+        }
+        if verify and intact_count:
+            images = np.memmap(
+                self.atlas_path,
+                dtype=np.uint8,
+                mode='r',
+                shape=(intact_count, SIZE[1], SIZE[0], 3),
+            )
+            damaged.update(
+                content_hash
+                for content_hash, slot in self.slots.items()
+                if slot < intact_count
+                and image_hash(images[slot]) != content_hash
+            )
+        return damaged
+
+    def remove_images(self, content_hashes: Set[str]) -> int:
+        # The emojis of removed images are missing, so they are downloaded
+        # again by the next sync
+        for content_hash in content_hashes:
+            self.slots.pop(content_hash, None)
+        removed_ids = [
+            emoji_id
+            for emoji_id, content_hash in self.ids.items()
+            if content_hash in content_hashes
+        ]
+        for emoji_id in removed_ids:
+            del self.ids[emoji_id]
+            self.manifest.pop(emoji_id, None)
+        return len(removed_ids)
+
+    def remove_emojis(self, keep_ids: Set[int]) -> int:
+        removed_ids = [
+            emoji_id for emoji_id in self.ids if int(emoji_id) not in keep_ids
+        ]
+        for emoji_id in removed_ids:
+            del self.ids[emoji_id]
+        for emoji_id in list(self.manifest):
+            if int(emoji_id) not in keep_ids:
+                del self.manifest[emoji_id]
+        return len(removed_ids)
+
+    def remove_old_generations(self) -> None:
+        # Left behind when compacting was interrupted, before or after
+        # atlas.json switched to the new generation
+        old_paths = {
+            self.directory.joinpath(ATLAS_FILE),
+            *self.directory.glob(ATLAS_GENERATION_FILE.format(generation='*')),
+        }
+        old_paths.discard(self.atlas_path)
+        for path in old_paths:
+            path.unlink(missing_ok=True)
+
+    def compact(self) -> int:
+        # Images that no emoji uses any more are dropped by copying the
+        # used ones into the next generation of the atlas. Saving atlas.json
+        # switches to it at once, so an interruption at any point leaves
+        # either the old atlas and slots or the new ones
+        self.remove_old_generations()
+        used_hashes = set(self.ids.values())
+        kept = sorted(
+            (slot, content_hash)
+            for content_hash, slot in self.slots.items()
+            if content_hash in used_hashes
+        )
+        freed_count = self.slot_count - len(kept)
+        if not freed_count:
+            return 0
+
+        generation = self.generation + 1
+        new_path = atlas_path(self.directory, generation)
+        slots = {}
+        try:
+            with open(new_path, 'wb') as file:
+                for slot, content_hash in kept:
+                    file.write(self.images[slot].tobytes())
+                    slots[content_hash] = len(slots)
+                file.flush()
+                os.fsync(file.fileno())
+        except BaseException:
+            new_path.unlink(missing_ok=True)
+            raise
+        self.mapped_images = None
+        self.generation = generation
+        self.atlas_path = new_path
+        self.slots = slots
+        self.slot_count = len(slots)
+        self.save()
+        self.remove_old_generations()
+        return freed_count
+
+    def save(self) -> None:
+        write_json(self.directory.joinpath(STORE_INDEX_FILE), self.ids)
+        write_json(self.directory.joinpath(MANIFEST_FILE), self.manifest)
+        # Written last, since it is what switches to a new generation
+        write_json(
+            self.directory.joinpath(ATLAS_INDEX_FILE),
+            {'generation': self.generation, 'slots': self.slots},
+        )
+
+
+def collapse_duplicates(emojis: List[Emoji], directory: Path) -> List[Emoji]:
+    # Emojis sharing an image are interchangeable in a mosaic, so only the
+    # one with the lowest ID (the oldest upload) is kept in the palette
+    atlas = EmojiAtlas(directory)
+    kept: Dict[str, Emoji] = {}
+    for emoji in emojis:
+        key = atlas.key(emoji)
+        if key not in kept or emoji.id < kept[key].id:
+            kept[key] = emoji
+    kept_emojis = set(kept.values())
+    return [emoji for emoji in emojis if emoji in kept_emojis]
+
+
+def import_legacy_images(directory: Path) -> int:
+    atlas = EmojiAtlas(directory)
+    legacy_paths = {}
+    for emoji_id, content_hash in atlas.ids.items():
+        path = directory.joinpath(STORE_FILE.format(hash=content_hash))
+        if content_hash not in atlas.slots and path.is_file():
+            legacy_paths[emoji_id] = path
+    for path in directory.glob(f'*{LEGACY_SUFFIX}'):
+        emoji_id = path.name[: -len(LEGACY_SUFFIX)]
+        if emoji_id.isdigit():
+            legacy_paths[emoji_id] = path
+
+    for emoji_id, path in legacy_paths.items():
+        with Image.open(path) as image:
+            atlas.add(int(emoji_id), np.asarray(image.convert('RGB')))
+
+    # The old files are only removed once the indexes point at the atlas
+    if legacy_paths:
+        atlas.save()
+    for path in set(legacy_paths.values()):
+        path.unlink()
+    return len(legacy_paths)
+
+
+def repair_images(directory: Path, verify: bool = False) -> int:
+    atlas = EmojiAtlas(directory)
+    damaged = atlas.damaged_images(verify)
+    if not damaged:
+        return 0
+    removed_count = atlas.remove_images(damaged)
+    atlas.save()
+    return removed_count
+
+
+def collect_garbage(directory: Path, keep_ids: Set[int]) -> Tuple[int, int]:
+    # Emojis that are no longer in emoji-data.json are forgotten, and then
+    # images that no emoji uses are removed from the atlas
+    atlas = EmojiAtlas(directory)
+    removed_count = atlas.remove_emojis(keep_ids)
+    if removed_count:
+        atlas.save()
+    return removed_count, atlas.compact()
@@ -0,0 +1,97 @@
+import json
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from .classes import Emoji
+from .constants import FEATURES_FILE, FEATURES_INDEX_FILE
+from .emoji_store import EmojiAtlas
+from .files import atomic_write
+from .profiling import profiled
+
+
+def image_features(
+    pixels: np.ndarray, resize: Tuple[int, int], resample: int
+) -> np.ndarray:
+    image = Image.fromarray(pixels)
+    resized_image = image.resize(resize, resample).convert('HSV')
+    return np.asarray(resized_image).transpose(2, 0, 1)
+
+
+def read_index(index_path: Path) -> Dict[str, List[int]]:
+    if not index_path.is_file():
+        return {}
+    return json.loads(index_path.read_text())
+
+
+@profiled('write_features')
+def write_features(
+    features_path: Path,
+    new_features: Dict[int, np.ndarray],
+    shape: Tuple[int, ...],
+) -> None:
+    with atomic_write(features_path, '.tmp.npy') as temp_path:
+        features = np.lib.format.open_memmap(
+            temp_path, mode='w+', dtype=np.uint8, shape=shape
+        )
+        if features_path.is_file():
+            old_features = np.load(features_path, mmap_mode='r')
+            old_count = min(len(old_features), shape[0])
+            features[:old_count] = old_features[:old_count]
+            del old_features
+        for row, row_features in new_features.items():
+            features[row] = row_features
+        features.flush()
+        del features
+
+
+@profiled('load_features')
+def load_features(
+    emojis: List[Emoji],
+    atlas: EmojiAtlas,
+    resize: Tuple[int, int],
+    resample: int,
+    cache_path: Optional[Path] = None,
+) -> np.ndarray:
+    if cache_path is None:
+        return np.stack(
+            [
+                image_features(atlas.image(emoji), resize, resample)
+                for emoji in emojis
+            ]
+        )
+
+    names = {'w': resize[0], 'h': resize[1], 'resample': int(resample)}
+    features_path = cache_path.joinpath(FEATURES_FILE.format(**names))
+    index_path = cache_path.joinpath(FEATURES_INDEX_FILE.format(**names))
+
+    index = read_index(index_path) if features_path.is_file() else {}
+    row_count = len(index)
+    stale_rows: Dict[int, np.ndarray] = {}
+
+    keys = [atlas.key(emoji) for emoji in emojis]
+    for emoji, key in zip(emojis, keys):
+        stamp = atlas.stamp(emoji)
+        entry = index.get(key)
+        if entry is not None and entry[1:] == stamp:
+            continue
+        if entry is None:
+            row = row_count
+            row_count += 1
+        else:
+            row = entry[0]
+        index[key] = [row, *stamp]
+        stale_rows[row] = image_features(atlas.image(emoji), resize, resample)
+
+    if stale_rows:
+        cache_path.mkdir(exist_ok=True)
+        shape = (row_count, 3, resize[1], resize[0])
+        write_features(features_path, stale_rows, shape)
+        with atomic_write(index_path) as temp_index_path:
+            temp_index_path.write_text(json.dumps(index))
+
+    features = np.load(features_path, mmap_mode='r')
+    rows = [index[key][0] for key in keys]
+    return features[rows]
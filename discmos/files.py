@@ -0,0 +1,16 @@
+import contextlib
+import os
+from pathlib import Path
+from typing import Iterator
+
+
+@contextlib.contextmanager
+def atomic_write(path: Path, suffix: str = '.tmp') -> Iterator[Path]:
+    # Written next to the file and renamed over it once complete, and
+    # deleted if writing fails so that nothing is left behind
+    temp_path = path.with_suffix(suffix)
+    try:
+        yield temp_path
+        os.replace(temp_path, path)
+    finally:
+        temp_path.unlink(missing_ok=True)
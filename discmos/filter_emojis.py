@@ -1,92 +1,125 @@
+import functools
 import re
-from typing import List, Set
+from collections import defaultdict
+from typing import Dict, Iterable, List, Set, Tuple
 
-from .classes import Emoji, EmojiData
+from .classes import Emoji, EmojiData, IncludeRule
 from .constants import (
     ALL_SEARCH,
+    INCLUDE_CACHE_SIZE,
     PREFIXES,
     REGEX_SEARCH,
     SPECIFIC_SEARCH,
     Mode,
 )
+from .profiling import profiled
 
 
-def filter_emojis(emoji_data: EmojiData, include: str) -> List[Emoji]:
-    emojis: Set[Emoji] = set()
-    current_servers = []
-    lines = include.split('\n')
+def compile_line(line: str) -> IncludeRule:
+    server = not line.startswith(PREFIXES['emoji'])
+    search = line if server else line.removeprefix(PREFIXES['emoji'])
 
-    for line in lines:
-        if line == '' or line.startswith('// '):
-            continue
-        elif line.startswith(PREFIXES['emoji']):
-            if len(current_servers) == 0:
-                raise ValueError(f'Line "{line}": emoji without server filter')
+    if search.startswith(PREFIXES['include']):
+        mode = Mode.INCLUDE
+        search = search.removeprefix(PREFIXES['include'])
+    elif search.startswith(PREFIXES['exclude']):
+        mode = Mode.EXCLUDE
+        search = search.removeprefix(PREFIXES['exclude'])
+    elif server:
+        mode = Mode.PASSIVE
+    else:
+        raise ValueError(f'Line "{line}": emoji must start with "+ " or "- "')
+
+    if server and ALL_SEARCH.search(search):
+        return IncludeRule(line, mode, server, 'all', '')
+    elif specific_search := SPECIFIC_SEARCH.search(search):
+        return IncludeRule(
+            line, mode, server, 'specific', specific_search.group()
+        )
+    elif regex_search := REGEX_SEARCH.search(search):
+        query = regex_search.group()
+        return IncludeRule(
+            line, mode, server, 'regex', query, re.compile(query)
+        )
+    else:
+        raise ValueError(f'Line "{line}": invalid server search')
+
+
+# The cache only lives as long as the process, so it helps the server, which
+# filters again whenever include.txt or emoji-data.json changes. One-shot
+# commands compile once anyway, and the regexes would have to be compiled
+# again after loading a copy from disk, so the rules are not persisted
+@functools.lru_cache(maxsize=INCLUDE_CACHE_SIZE)
+def compile_include(include: str) -> Tuple[IncludeRule, ...]:
+    return tuple(
+        compile_line(line)
+        for line in include.split('\n')
+        if not (line == '' or line.startswith('// '))
+    )
 
-            emoji_search = line.removeprefix(PREFIXES['emoji'])
 
-            if emoji_search.startswith(PREFIXES['include']):
-                mode = Mode.INCLUDE
-                emoji_search = emoji_search.removeprefix(PREFIXES['include'])
-            elif emoji_search.startswith(PREFIXES['exclude']):
-                mode = Mode.EXCLUDE
-                emoji_search = emoji_search.removeprefix(PREFIXES['exclude'])
+def index_emojis(
+    emoji_data: EmojiData,
+) -> Tuple[Dict[str, List[Emoji]], Dict[Tuple[str, str], List[Emoji]]]:
+    by_server: Dict[str, List[Emoji]] = defaultdict(list)
+    by_name: Dict[Tuple[str, str], List[Emoji]] = defaultdict(list)
+    for emoji in emoji_data.emojis:
+        by_server[emoji.server].append(emoji)
+        by_name[(emoji.server, emoji.name)].append(emoji)
+    return by_server, by_name
+
+
+@profiled('filter_emojis')
+def filter_emojis(emoji_data: EmojiData, include: str) -> List[Emoji]:
+    rules = compile_include(include)
+    by_server, by_name = index_emojis(emoji_data)
+    servers = list(emoji_data.servers)
+
+    emojis: Set[Emoji] = set()
+    current_servers: List[str] = []
+
+    for rule in rules:
+        current_emojis: Iterable[Emoji]
+        if rule.server:
+            if rule.search == 'all':
+                current_servers = servers
+            elif rule.search == 'specific':
+                if rule.query not in emoji_data.servers:
+                    raise ValueError(
+                        f'Line "{rule.line}": invalid server search'
+                    )
+                current_servers = [rule.query]
             else:
+                current_servers = list(filter(rule.pattern.search, servers))
+
+            current_emojis = (
+                emoji
+                for server in current_servers
+                for emoji in by_server[server]
+            )
+        else:
+            if len(current_servers) == 0:
                 raise ValueError(
-                    f'Line "{line}": emoji must start with "+ " or "- "'
+                    f'Line "{rule.line}": emoji without server filter'
                 )
 
-            if specific_search := SPECIFIC_SEARCH.search(emoji_search):
-                current_emojis = filter(
-                    lambda emoji: emoji.name == specific_search.group(),
-                    servers_emojis,
-                )
-            elif regex_search := REGEX_SEARCH.search(emoji_search):
-                compiled: re.Pattern = re.compile(regex_search.group())
-                current_emojis = filter(
-                    lambda emoji: compiled.search(emoji.name),
-                    emoji_data.emojis,
+            if rule.search == 'specific':
+                current_emojis = (
+                    emoji
+                    for server in current_servers
+                    for emoji in by_name.get((server, rule.query), ())
                 )
             else:
-                raise ValueError(f'Line "{line}": invalid server search')
-
-            if mode == Mode.INCLUDE:
-                emojis.update(current_emojis)
-            else:
-                emojis.difference_update(current_emojis)
-        else:
-            if line.startswith(PREFIXES['include']):
-                mode = Mode.INCLUDE
-                server_search = line.removeprefix(PREFIXES['include'])
-            elif line.startswith(PREFIXES['exclude']):
-                mode = Mode.EXCLUDE
-                server_search = line.removeprefix(PREFIXES['exclude'])
-            else:
-                mode = Mode.PASSIVE
-                server_search = line
-
-            if ALL_SEARCH.search(server_search):
-                current_servers = list(emoji_data.servers)
-            elif (
-                specific_search := SPECIFIC_SEARCH.search(server_search)
-            ) and (specific_search.group() in emoji_data.servers):
-                current_servers = [specific_search.group()]
-            elif regex_search := REGEX_SEARCH.search(server_search):
-                compiled: re.Pattern = re.compile(regex_search.group())
-                current_servers = list(
-                    filter(compiled.search, emoji_data.servers)
+                current_emojis = (
+                    emoji
+                    for server in current_servers
+                    for emoji in by_server[server]
+                    if rule.pattern.search(emoji.name)
                 )
-            else:
-                raise ValueError(f'Line "{line}": invalid server search')
 
-            servers_emojis = filter(
-                lambda emoji: emoji.server in current_servers,
-                emoji_data.emojis,
-            )
-            if mode in (Mode.INCLUDE, Mode.EXCLUDE):
-                if mode == Mode.INCLUDE:
-                    emojis.update(servers_emojis)
-                else:
-                    emojis.difference_update(servers_emojis)
+        if rule.mode == Mode.INCLUDE:
+            emojis.update(current_emojis)
+        elif rule.mode == Mode.EXCLUDE:
+            emojis.difference_update(current_emojis)
 
-    return list(emojis)
+    return sorted(emojis, key=lambda emoji: emoji.id)
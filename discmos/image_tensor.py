@@ -1,3 +1,5 @@
+from typing import Tuple
+
 import torch
 import torchvision
 import torchvision.transforms.functional
@@ -12,3 +14,14 @@ def image_to_tensor(image: Image.Image) -> torch.Tensor:
 def tensor_to_image(tensor: torch.tensor) -> Image.Image:
     image = torchvision.transforms.ToPILImage()(tensor)
     return image
+
+
+def image_to_tiles(
+    tensor: torch.Tensor, tile_size: Tuple[int, int]
+) -> torch.Tensor:
+    # (channel, row, column, height, width) view of non-overlapping tiles
+    tiles = tensor.unfold(1, tile_size[1], tile_size[1]).unfold(
+        2, tile_size[0], tile_size[0]
+    )
+    # Column-major tile order, so tiles of one column of the image are adjacent
+    return tiles.permute(2, 1, 0, 3, 4)
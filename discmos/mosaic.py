@@ -1,96 +1,321 @@
 import math
+import time
 from pathlib import Path
-from typing import List, Tuple
+from typing import Any, BinaryIO, Dict, List, Optional, Tuple, Union
 
-import torch
-from PIL import Image
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
 
+from . import profiling
+from .backend import Array, get_backend
 from .classes import Emoji
-from .constants import EMOJI_FILE, SIZE
-from .image_tensor import image_to_tensor
+from .constants import CONTACT_SHEET_MARGIN, MEMORY_BUDGET, SIZE, TOP_K
+from .emoji_store import EmojiAtlas, collapse_duplicates
+from .feature_cache import load_features
+from .png_stream import PngWriter
+from .run_cache import (
+    find_closest_tiles_incremental,
+    match_state_path,
+    read_source_tiles,
+    source_key,
+    write_source_tiles,
+)
 
 
+def get_device() -> Any:
+    return get_backend().device
+
+
+def to_device(array: Array, device: Any) -> Array:
+    return get_backend().to_device(array, device)
+
+
+@profiling.profiled('find_closest_tiles')
 def find_closest_tiles(
-    match_tiles: torch.Tensor,
-    source_tiles: torch.Tensor,
-    channel_weights: torch.Tensor,
-) -> torch.Tensor:
-    return (
-        (source_tiles[:, None, ...] - match_tiles[None, :, ...])
-        .abs()
-        .mul(channel_weights[None, None, :, None])
-        .flatten(start_dim=2)
-        .sum(2)
-        .argmin(1)
+    match_tiles: Array,
+    source_tiles: Array,
+    channel_weights: Array,
+    memory_budget: int = MEMORY_BUDGET,
+    metric: str = 'l1',
+) -> Array:
+    if metric not in ('l1', 'l2'):
+        raise ValueError(f'Unknown metric "{metric}"')
+    return get_backend().find_closest_tiles(
+        match_tiles, source_tiles, channel_weights, memory_budget, metric
     )
 
 
-def run_mosaic(
+@profiling.profiled('find_closest_tiles_sweep')
+def find_closest_tiles_sweep(
+    match_tiles: Array,
+    source_tiles: Array,
+    channel_weight_sets: List[Array],
+    memory_budget: int = MEMORY_BUDGET,
+    metric: str = 'l1',
+) -> Array:
+    if metric not in ('l1', 'l2'):
+        raise ValueError(f'Unknown metric "{metric}"')
+    return get_backend().find_closest_tiles_sweep(
+        match_tiles, source_tiles, channel_weight_sets, memory_budget, metric
+    )
+
+
+@profiling.profiled('deduplicate_tiles')
+def deduplicate_tiles(source_tiles: Array) -> Tuple[Array, Array]:
+    # Flat backgrounds and pixel art repeat the same tile many times, so
+    # each distinct tile is matched once and the result is scattered back
+    return get_backend().deduplicate_tiles(source_tiles)
+
+
+def image_to_source_tiles(
+    source_image_full: Image.Image,
+    width_emojis: int,
+    resize: Tuple[int, int],
+    resample: int,
+) -> Array:
+    with profiling.stage('resize_source'):
+        source_size = (
+            width_emojis * resize[0],
+            math.floor(
+                source_image_full.height
+                / source_image_full.width
+                * width_emojis
+            )
+            * resize[1],
+        )
+        source_image = Image.new('RGBA', source_size)
+        source_image.alpha_composite(
+            source_image_full.resize(source_size, resample)
+        )
+    with profiling.stage('hsv_conversion'):
+        source_image = source_image.convert('HSV')
+
+    source_tiles = get_backend().tiles_from_image(source_image, resize)
+    profiling.record_tensor(source_tiles)
+    return source_tiles
+
+
+@profiling.profiled('load_source_tiles')
+def load_source_tiles(
+    source_path: Union[Path, BinaryIO],
+    width_emojis: int,
+    resize: Tuple[int, int],
+    resample: int,
+) -> Array:
+    with profiling.stage('decode_source'):
+        source_image_full = Image.open(source_path).convert('RGBA')
+    return image_to_source_tiles(
+        source_image_full, width_emojis, resize, resample
+    )
+
+
+@profiling.profiled('load_match_tiles')
+def load_match_tiles(
     emojis: List[Emoji],
     images_path: Path,
-    source_path: Path,
-    width_emojis: int,
     resize: Tuple[int, int],
     resample: int,
+    cache_path: Optional[Path] = None,
+) -> Array:
+    features = load_features(
+        emojis, EmojiAtlas(images_path), resize, resample, cache_path
+    )
+
+    match_tiles = get_backend().tiles_from_features(features)
+    profiling.record_tensor(match_tiles)
+    return match_tiles
+
+
+def get_channel_weights(
     hue_weight: float,
     saturation_weight: float,
     value_weight: float,
-) -> List[List[Emoji]]:
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    image_tensors = []
+    device: Any,
+) -> Array:
+    channel_weights = get_backend().channel_weights(
+        [hue_weight, saturation_weight, value_weight], device
+    )
+    return channel_weights
 
-    for emoji in emojis:
-        image_path = images_path.joinpath(EMOJI_FILE.format(ID=emoji.id))
-        image = Image.open(image_path)
-        resized_image = image.resize(resize, resample).convert('HSV')
 
-        image_tensor = image_to_tensor(resized_image).type(torch.short)
-        image_tensors.append(image_tensor)
+def load_palette_index(
+    match_tiles: Array,
+    channel_weights: Array,
+    resize: Tuple[int, int],
+    resample: int,
+    memory_budget: int = MEMORY_BUDGET,
+    cache_path: Optional[Path] = None,
+    matcher: str = 'exact',
+    metric: str = 'l1',
+) -> Optional[Any]:
+    # Hashing the palette and loading the prefilter or lookup table is only
+    # done once when many images or frames are matched with one palette
+    if matcher == 'exact':
+        return None
+    if get_backend().name != 'torch':
+        raise ValueError(f'The {matcher} matcher needs the torch backend')
+    if matcher == 'coarse':
+        return None
+    # Imported here so that the NumPy backend never imports torch
+    from .palette_index import load_color_lut, load_prefilter
+
+    if matcher == 'approximate':
+        return load_prefilter(
+            match_tiles, channel_weights, resize, resample, cache_path
+        )
+    if resize != (1, 1):
+        raise ValueError('The lut matcher needs a resize of 1')
+    return load_color_lut(
+        match_tiles,
+        channel_weights,
+        resample,
+        cache_path,
+        memory_budget=memory_budget,
+        metric=metric,
+    )
+
 
-    match_tiles: torch.Tensor = torch.stack(image_tensors).to(device)
-    match_tiles = match_tiles.flatten(start_dim=2)
+def match_source_tiles(
+    emojis: List[Emoji],
+    match_tiles: Array,
+    source_tiles: Array,
+    channel_weights: Array,
+    resize: Tuple[int, int],
+    resample: int,
+    memory_budget: int = MEMORY_BUDGET,
+    cache_path: Optional[Path] = None,
+    matcher: str = 'exact',
+    top_k: int = TOP_K,
+    metric: str = 'l1',
+    stats: Optional[Dict[str, float]] = None,
+    state_path: Optional[Path] = None,
+    palette_index: Optional[Any] = None,
+) -> Array:
+    start_time = time.perf_counter()
+    tile_count = len(source_tiles)
+    tile_indices = None
+    # A lookup per tile is already cheaper than finding the unique tiles
+    if matcher != 'lut':
+        source_tiles, tile_indices = deduplicate_tiles(source_tiles)
 
-    source_image_full = Image.open(source_path).convert('RGBA')
-    source_size = (
-        width_emojis * resize[0],
-        math.floor(
-            source_image_full.height / source_image_full.width * width_emojis
+    if palette_index is None:
+        palette_index = load_palette_index(
+            match_tiles,
+            channel_weights,
+            resize,
+            resample,
+            memory_budget,
+            cache_path,
+            matcher,
+            metric,
+        )
+    if matcher != 'exact':
+        # Imported here so that the NumPy backend never imports torch
+        from .palette_index import (
+            find_closest_tiles_approximate,
+            find_closest_tiles_coarse,
+            find_closest_tiles_lut,
         )
-        * resize[1],
-    )
-    source_image = Image.new('RGBA', source_size)
-    source_image.alpha_composite(
-        source_image_full.resize(source_size, resample)
-    )
-    source_image = source_image.convert('HSV')
-    source_images = [
-        image_to_tensor(
-            source_image.crop((x, y, x + resize[0], y + resize[1]))
-        ).type(torch.short)
-        for x in range(0, source_image.width, resize[0])
-        for y in range(0, source_image.height, resize[1])
-    ]
 
-    source_tiles: torch.Tensor = torch.stack(source_images).to(device)
-    source_tiles = source_tiles.flatten(start_dim=2)
+    if matcher == 'exact' and state_path is not None:
+        closest_tiles = find_closest_tiles_incremental(
+            emojis,
+            match_tiles,
+            source_tiles,
+            channel_weights,
+            state_path,
+            memory_budget,
+            metric,
+            stats,
+        )
+    elif matcher == 'exact':
+        closest_tiles = find_closest_tiles(
+            match_tiles, source_tiles, channel_weights, memory_budget, metric
+        )
+    elif matcher == 'approximate':
+        closest_tiles = find_closest_tiles_approximate(
+            match_tiles,
+            source_tiles,
+            channel_weights,
+            palette_index,
+            top_k,
+            memory_budget,
+            metric,
+        )
+    elif matcher == 'coarse':
+        closest_tiles = find_closest_tiles_coarse(
+            match_tiles,
+            source_tiles,
+            channel_weights,
+            resize,
+            top_k,
+            memory_budget,
+            metric,
+        )
+    elif matcher == 'lut':
+        closest_tiles = find_closest_tiles_lut(source_tiles, palette_index)
+    else:
+        raise ValueError(f'Unknown matcher "{matcher}"')
 
-    channel_weights_list = [hue_weight, saturation_weight, value_weight]
-    channel_dtype = (
-        torch.short
-        if all(weight.is_integer() for weight in channel_weights_list)
-        else torch.float32
-    )
+    if tile_indices is not None:
+        closest_tiles = closest_tiles[tile_indices]
 
-    channel_weights = torch.tensor(
-        [hue_weight, saturation_weight, value_weight],
-        dtype=channel_dtype,
-        device=device,
-    )
+    if stats is not None:
+        stats['match_seconds'] = time.perf_counter() - start_time
+        stats['unique_tiles'] = len(source_tiles)
+        stats['dedup_ratio'] = tile_count / max(1, len(source_tiles))
+        if matcher != 'exact':
+            start_time = time.perf_counter()
+            exact_tiles = find_closest_tiles(
+                match_tiles,
+                source_tiles,
+                channel_weights,
+                memory_budget,
+                metric,
+            )
+            if tile_indices is not None:
+                exact_tiles = exact_tiles[tile_indices]
+            stats['exact_match_seconds'] = time.perf_counter() - start_time
+            stats['recall'] = (
+                (closest_tiles == exact_tiles).float().mean().item()
+            )
+    return closest_tiles
 
-    closest_tiles = find_closest_tiles(
-        match_tiles, source_tiles, channel_weights
-    )
 
+@profiling.profiled('match_mosaic')
+def match_mosaic(
+    emojis: List[Emoji],
+    match_tiles: Array,
+    source_tiles: Array,
+    width_emojis: int,
+    channel_weights: Array,
+    resize: Tuple[int, int],
+    resample: int,
+    memory_budget: int = MEMORY_BUDGET,
+    cache_path: Optional[Path] = None,
+    matcher: str = 'exact',
+    top_k: int = TOP_K,
+    metric: str = 'l1',
+    stats: Optional[Dict[str, float]] = None,
+    state_path: Optional[Path] = None,
+    palette_index: Optional[Any] = None,
+) -> List[List[Emoji]]:
+    closest_tiles = match_source_tiles(
+        emojis,
+        match_tiles,
+        source_tiles,
+        channel_weights,
+        resize,
+        resample,
+        memory_budget,
+        cache_path,
+        matcher,
+        top_k,
+        metric,
+        stats,
+        state_path,
+        palette_index,
+    )
     output_emojis = [
         [emojis[index] for index in row]
         for row in closest_tiles.reshape((width_emojis, -1)).T.tolist()
@@ -98,19 +323,288 @@ def run_mosaic(
     return output_emojis
 
 
+def cached_source_tiles(
+    source_path: Path,
+    width_emojis: int,
+    resize: Tuple[int, int],
+    resample: int,
+    cache_path: Optional[Path] = None,
+    key: Optional[str] = None,
+) -> Array:
+    if cache_path is None:
+        return load_source_tiles(source_path, width_emojis, resize, resample)
+    if key is None:
+        key = source_key(source_path, width_emojis, resize, resample)
+    source_tiles = read_source_tiles(cache_path, key)
+    if source_tiles is None:
+        source_tiles = load_source_tiles(
+            source_path, width_emojis, resize, resample
+        )
+        write_source_tiles(cache_path, key, source_tiles)
+    return source_tiles
+
+
+def run_mosaic(
+    emojis: List[Emoji],
+    images_path: Path,
+    source_path: Path,
+    width_emojis: int,
+    resize: Tuple[int, int],
+    resample: int,
+    hue_weight: float,
+    saturation_weight: float,
+    value_weight: float,
+    memory_budget: int = MEMORY_BUDGET,
+    cache_path: Optional[Path] = None,
+    matcher: str = 'exact',
+    top_k: int = TOP_K,
+    metric: str = 'l1',
+    stats: Optional[Dict[str, float]] = None,
+) -> List[List[Emoji]]:
+    palette_size = len(emojis)
+    emojis = collapse_duplicates(emojis, images_path)
+    if stats is not None:
+        stats['duplicate_emojis'] = palette_size - len(emojis)
+
+    device = get_device()
+    match_tiles = to_device(
+        load_match_tiles(emojis, images_path, resize, resample, cache_path),
+        device,
+    )
+    channel_weights = get_channel_weights(
+        hue_weight, saturation_weight, value_weight, device
+    )
+
+    # Decoded source tiles and match results are kept per source image, so
+    # changing the weights or include.txt does not start from scratch
+    key = None
+    state_path = None
+    if cache_path is not None:
+        key = source_key(source_path, width_emojis, resize, resample)
+        state_path = match_state_path(cache_path, key, channel_weights, metric)
+    source_tiles = to_device(
+        cached_source_tiles(
+            source_path, width_emojis, resize, resample, cache_path, key
+        ),
+        device,
+    )
+
+    return match_mosaic(
+        emojis,
+        match_tiles,
+        source_tiles,
+        width_emojis,
+        channel_weights,
+        resize,
+        resample,
+        memory_budget,
+        cache_path,
+        matcher,
+        top_k,
+        metric,
+        stats,
+        state_path,
+    )
+
+
+def run_mosaic_sweep(
+    emojis: List[Emoji],
+    images_path: Path,
+    source_path: Path,
+    width_emojis: int,
+    resize: Tuple[int, int],
+    resample: int,
+    weight_sets: List[Tuple[float, float, float]],
+    memory_budget: int = MEMORY_BUDGET,
+    cache_path: Optional[Path] = None,
+    metric: str = 'l1',
+    stats: Optional[Dict[str, float]] = None,
+) -> List[List[List[Emoji]]]:
+    # The palette and the source tiles are loaded once, and each block of
+    # differences is computed once for every set of weights
+    palette_size = len(emojis)
+    emojis = collapse_duplicates(emojis, images_path)
+    device = get_device()
+    match_tiles = to_device(
+        load_match_tiles(emojis, images_path, resize, resample, cache_path),
+        device,
+    )
+    channel_weight_sets = [
+        get_channel_weights(*weights, device) for weights in weight_sets
+    ]
+    source_tiles = to_device(
+        cached_source_tiles(
+            source_path, width_emojis, resize, resample, cache_path
+        ),
+        device,
+    )
+
+    start_time = time.perf_counter()
+    unique_tiles, tile_indices = deduplicate_tiles(source_tiles)
+    closest_tiles = find_closest_tiles_sweep(
+        match_tiles, unique_tiles, channel_weight_sets, memory_budget, metric
+    )
+    closest_tiles = get_backend().to_numpy(closest_tiles)[
+        :, get_backend().to_numpy(tile_indices)
+    ]
+    if stats is not None:
+        stats['duplicate_emojis'] = palette_size - len(emojis)
+        stats['match_seconds'] = time.perf_counter() - start_time
+        stats['unique_tiles'] = len(unique_tiles)
+        stats['weight_sets'] = len(weight_sets)
+
+    return [
+        [
+            [emojis[index] for index in row]
+            for row in set_tiles.reshape((width_emojis, -1)).T.tolist()
+        ]
+        for set_tiles in closest_tiles
+    ]
+
+
+def decode_emoji_cells(
+    emojis: List[Emoji], images_path: Path, cell_size: Tuple[int, int]
+) -> np.ndarray:
+    cells = np.empty(
+        (len(emojis), cell_size[1], cell_size[0], 3), dtype=np.uint8
+    )
+    atlas = EmojiAtlas(images_path)
+    with profiling.stage('decode_emojis'):
+        for index, emoji in enumerate(emojis):
+            pixels = atlas.image(emoji)
+            if pixels.shape[1::-1] != cell_size:
+                pixels = np.asarray(
+                    Image.fromarray(pixels).resize(cell_size, Image.LANCZOS)
+                )
+            cells[index] = pixels
+    return cells
+
+
+@profiling.profiled('run_composite')
 def run_composite(
-    emoji_rows: List[List[Emoji]], images_path: Path
+    emoji_rows: List[List[Emoji]],
+    images_path: Path,
+    cell_size: Tuple[int, int] = SIZE,
 ) -> Image.Image:
-    width = len(emoji_rows[0]) * SIZE[0]
-    height = len(emoji_rows) * SIZE[1]
-    composite_image = Image.new('RGB', (width, height))
+    unique_emojis = list(
+        dict.fromkeys(emoji for row in emoji_rows for emoji in row)
+    )
+    palette_indices = {
+        emoji: index for index, emoji in enumerate(unique_emojis)
+    }
+
+    # Each emoji is decoded and scaled to the final cell size only once
+    palette = decode_emoji_cells(unique_emojis, images_path, cell_size)
+
+    grid = np.array(
+        [[palette_indices[emoji] for emoji in row] for row in emoji_rows]
+    )
+    rows, columns = grid.shape
+    composite = np.empty(
+        (rows * cell_size[1], columns * cell_size[0], 3), dtype=np.uint8
+    )
+    cells = composite.reshape(rows, cell_size[1], columns, cell_size[0], 3)
+    for row_index in range(rows):
+        cells[row_index] = palette[grid[row_index]].transpose(1, 0, 2, 3)
+
+    return Image.fromarray(composite)
+
 
-    for row_index, row in enumerate(emoji_rows):
+@profiling.profiled('write_composite')
+def write_composite(
+    emoji_rows: List[List[Emoji]],
+    images_path: Path,
+    file: BinaryIO,
+    cell_size: Tuple[int, int] = SIZE,
+) -> Tuple[int, int]:
+    columns = len(emoji_rows[0])
+    size = (columns * cell_size[0], len(emoji_rows) * cell_size[1])
+    writer = PngWriter(file, size)
+
+    # Only one row of emojis is rendered at a time, so memory does not grow
+    # with the height of the mosaic, and at full size the cells are views
+    # into the atlas
+    atlas = EmojiAtlas(images_path)
+    cells: Dict[Emoji, np.ndarray] = {}
+    strip = np.empty((cell_size[1], size[0], 3), dtype=np.uint8)
+    strip_cells = strip.reshape(cell_size[1], columns, cell_size[0], 3)
+    for row in emoji_rows:
         for column_index, emoji in enumerate(row):
-            image_path = images_path.joinpath(EMOJI_FILE.format(ID=emoji.id))
-            image = Image.open(image_path)
-            composite_image.paste(
-                image, (column_index * SIZE[0], row_index * SIZE[1])
-            )
+            if emoji not in cells:
+                pixels = atlas.image(emoji)
+                if pixels.shape[1::-1] != cell_size:
+                    pixels = np.asarray(
+                        Image.fromarray(pixels).resize(
+                            cell_size, Image.LANCZOS
+                        )
+                    )
+                cells[emoji] = pixels
+            strip_cells[:, column_index] = cells[emoji]
+        writer.write_rows(strip)
+    writer.close()
+    return size
+
+
+def emojis_to_text(output_emojis: List[List[Emoji]]) -> str:
+    output_text = ''
+    for row in output_emojis:
+        for emoji in row:
+            output_text += f':{emoji.name}: '
+        output_text.removesuffix(' ')
+        output_text += '\n'
+    return output_text
+
+
+def composite_cell_size(columns: int, resize_width: int) -> Tuple[int, int]:
+    # Render directly at (about) the final size instead of downscaling a
+    # full-resolution canvas
+    cell_width = max(1, math.ceil(resize_width / columns))
+    return (cell_width, max(1, cell_width * SIZE[1] // SIZE[0]))
+
+
+def render_contact_sheet(
+    images: List[Image.Image], labels: List[str], columns: int
+) -> Image.Image:
+    # The images of a sweep share one size, so they are laid out in a grid
+    # with each label in a strip under its image
+    font = ImageFont.load_default()
+    label_height = font.getbbox('Ag')[3] + 2 * CONTACT_SHEET_MARGIN
+    width, height = images[0].size
+    cell_size = (
+        width + CONTACT_SHEET_MARGIN,
+        height + label_height + CONTACT_SHEET_MARGIN,
+    )
+    rows = math.ceil(len(images) / columns)
+    sheet = Image.new(
+        'RGB',
+        (
+            columns * cell_size[0] + CONTACT_SHEET_MARGIN,
+            rows * cell_size[1] + CONTACT_SHEET_MARGIN,
+        ),
+        'white',
+    )
+    draw = ImageDraw.Draw(sheet)
+    for index, (image, label) in enumerate(zip(images, labels)):
+        left = index % columns * cell_size[0] + CONTACT_SHEET_MARGIN
+        top = index // columns * cell_size[1] + CONTACT_SHEET_MARGIN
+        sheet.paste(image, (left, top))
+        draw.text(
+            (left, top + height + CONTACT_SHEET_MARGIN),
+            label,
+            fill='black',
+            font=font,
+        )
+    return sheet
+
+
+def render_composite(
+    output_emojis: List[List[Emoji]], images_path: Path, resize_width: int
+) -> Image.Image:
+    columns = len(output_emojis[0])
+    size = (resize_width, round(len(output_emojis) / columns * resize_width))
+    cell_size = composite_cell_size(columns, resize_width)
 
-    return composite_image
+    image = run_composite(output_emojis, images_path, cell_size)
+    if image.size != size:
+        image = image.resize(size, Image.LANCZOS)
+    return image
@@ -0,0 +1,271 @@
+from typing import List, Tuple
+
+import numpy as np
+from PIL import Image
+
+from . import profiling
+from .backend import Backend, block_sizes
+from .constants import MEMORY_BUDGET
+
+
+def channel_sum_dtype(tiles: np.ndarray) -> type:
+    # Per-channel sums of uint8 differences fit in int16 up to 128 pixels
+    return np.int16 if tiles.shape[-1] * 255 < 2**15 else np.int32
+
+
+def find_closest_tiles_l1(
+    match_tiles: np.ndarray,
+    source_tiles: np.ndarray,
+    channel_weight_sets: List[np.ndarray],
+    memory_budget: int = MEMORY_BUDGET,
+) -> np.ndarray:
+    # Tiles stay uint8, and the weights are applied to the per-channel sums,
+    # which is exact for integer weights. The sums of a block are shared by
+    # every set of weights, so a sweep costs little more than one run
+    pair_bytes = 2 * match_tiles[0].size * match_tiles.itemsize
+    match_block, source_block = block_sizes(
+        len(match_tiles), len(source_tiles), pair_bytes, memory_budget
+    )
+    # Every block reuses two uint8 buffers, since |s - m| is
+    # max(s, m) - min(s, m) without widening
+    shape = (min(source_block, len(source_tiles)), match_block)
+    upper_buffer = np.empty(shape + match_tiles.shape[1:], dtype=np.uint8)
+    lower_buffer = np.empty_like(upper_buffer)
+    sum_dtype = channel_sum_dtype(match_tiles)
+    profiling.record_tensor(upper_buffer)
+    profiling.record_tensor(lower_buffer)
+
+    closest_tiles = np.empty(
+        (len(channel_weight_sets), len(source_tiles)), dtype=np.int64
+    )
+    for source_start in range(0, len(source_tiles), source_block):
+        source_chunk = source_tiles[source_start : source_start + source_block]
+        best_distances = [None] * len(channel_weight_sets)
+        best_indices = [None] * len(channel_weight_sets)
+
+        for match_start in range(0, len(match_tiles), match_block):
+            match_chunk = match_tiles[match_start : match_start + match_block]
+            upper = upper_buffer[: len(source_chunk), : len(match_chunk)]
+            lower = lower_buffer[: len(source_chunk), : len(match_chunk)]
+            np.maximum(source_chunk[:, None], match_chunk[None], out=upper)
+            np.minimum(source_chunk[:, None], match_chunk[None], out=lower)
+            np.subtract(upper, lower, out=upper)
+            sums = upper.sum(3, dtype=sum_dtype)
+
+            for set_index, channel_weights in enumerate(channel_weight_sets):
+                distances = sums @ channel_weights
+                indices = distances.argmin(1)
+                chunk_distances = np.take_along_axis(
+                    distances, indices[:, None], 1
+                )[:, 0]
+                indices += match_start
+
+                if best_distances[set_index] is None:
+                    best_distances[set_index] = chunk_distances
+                    best_indices[set_index] = indices
+                else:
+                    # Strictly less keeps the earliest index on ties, like
+                    # argmin
+                    closer = chunk_distances < best_distances[set_index]
+                    best_distances[set_index][closer] = chunk_distances[closer]
+                    best_indices[set_index][closer] = indices[closer]
+
+        closest_tiles[:, source_start : source_start + source_block] = (
+            best_indices
+        )
+
+    return closest_tiles
+
+
+def weighted_features(
+    tiles: np.ndarray, channel_weights: np.ndarray
+) -> np.ndarray:
+    weights = channel_weights.astype(np.float32)[None, :, None]
+    return (tiles.astype(np.float32) * weights).reshape(len(tiles), -1)
+
+
+def find_closest_tiles_l2(
+    match_tiles: np.ndarray,
+    source_tiles: np.ndarray,
+    channel_weights: np.ndarray,
+    memory_budget: int = MEMORY_BUDGET,
+) -> np.ndarray:
+    # |s - m|^2 = |s|^2 + |m|^2 - 2 s.m, and |s|^2 is the same for every
+    # emoji, so one matrix multiply per block ranks the whole palette. The
+    # terms pass 2^24 for large tiles, so they are summed in float64 to
+    # keep near ties in the right order
+    match_features = weighted_features(match_tiles, channel_weights).astype(
+        np.float64
+    )
+    match_norms = np.square(match_features).sum(1)
+    source_block = max(
+        1, min(len(source_tiles), memory_budget // (len(match_tiles) * 8))
+    )
+    buffer = np.empty((source_block, len(match_tiles)), dtype=np.float64)
+    profiling.record_tensor(match_features)
+    profiling.record_tensor(buffer)
+
+    closest_tiles = np.empty(len(source_tiles), dtype=np.int64)
+    for source_start in range(0, len(source_tiles), source_block):
+        source_chunk = source_tiles[source_start : source_start + source_block]
+        source_features = weighted_features(
+            source_chunk, channel_weights
+        ).astype(np.float64)
+        distances = buffer[: len(source_chunk)]
+        np.matmul(source_features, match_features.T, out=distances)
+        distances *= -2
+        distances += match_norms[None, :]
+        closest_tiles[source_start : source_start + source_block] = (
+            distances.argmin(1)
+        )
+
+    return closest_tiles
+
+
+def find_closest_tiles_l2_sweep(
+    match_tiles: np.ndarray,
+    source_tiles: np.ndarray,
+    channel_weight_sets: List[np.ndarray],
+    memory_budget: int = MEMORY_BUDGET,
+) -> np.ndarray:
+    # The weighted distance is sum_c w_c^2 (|m_c|^2 - 2 s_c.m_c) plus a
+    # constant per tile, so one batched matrix multiply per block gives the
+    # per-channel terms that every set of weights is ranked with, in
+    # float64 like find_closest_tiles_l2
+    match_features = match_tiles.astype(np.float64)
+    match_norms = np.square(match_features).sum(2).T[:, None, :]
+    match_features = match_features.transpose(1, 2, 0)
+    squared_weights = [
+        np.square(channel_weights.astype(np.float64))
+        for channel_weights in channel_weight_sets
+    ]
+    source_block = max(
+        1, min(len(source_tiles), memory_budget // (len(match_tiles) * 32))
+    )
+    buffer = np.empty((3, source_block, len(match_tiles)), dtype=np.float64)
+    profiling.record_tensor(match_features)
+    profiling.record_tensor(buffer)
+
+    closest_tiles = np.empty(
+        (len(channel_weight_sets), len(source_tiles)), dtype=np.int64
+    )
+    for source_start in range(0, len(source_tiles), source_block):
+        source_chunk = source_tiles[source_start : source_start + source_block]
+        source_features = source_chunk.astype(np.float64).transpose(1, 0, 2)
+        terms = buffer[:, : len(source_chunk)]
+        np.matmul(source_features, match_features, out=terms)
+        terms *= -2
+        terms += match_norms
+        for set_index, weights in enumerate(squared_weights):
+            closest_tiles[
+                set_index, source_start : source_start + source_block
+            ] = np.tensordot(weights, terms, 1).argmin(1)
+
+    return closest_tiles
+
+
+class NumpyBackend(Backend):
+    name = 'numpy'
+
+    @property
+    def device(self) -> str:
+        return 'cpu'
+
+    def to_device(self, array: np.ndarray, device: str) -> np.ndarray:
+        return array
+
+    def tiles_from_image(
+        self, image: Image.Image, tile_size: Tuple[int, int]
+    ) -> np.ndarray:
+        pixels = np.asarray(image)
+        rows = pixels.shape[0] // tile_size[1]
+        columns = pixels.shape[1] // tile_size[0]
+        # (column, row, channel, height, width), in the same column-major
+        # tile order as image_to_tiles
+        tiles = (
+            pixels[: rows * tile_size[1], : columns * tile_size[0]]
+            .reshape(rows, tile_size[1], columns, tile_size[0], -1)
+            .transpose(2, 0, 4, 1, 3)
+        )
+        return tiles.astype(np.uint8, order='C').reshape(
+            columns * rows, tiles.shape[2], -1
+        )
+
+    def tiles_from_features(self, features: np.ndarray) -> np.ndarray:
+        return features.reshape(*features.shape[:2], -1)
+
+    def channel_weights(self, weights: List[float], device: str) -> np.ndarray:
+        dtype = (
+            np.int32
+            if all(weight.is_integer() for weight in weights)
+            else np.float32
+        )
+        return np.array(weights, dtype=dtype)
+
+    def concatenate(self, arrays: List[np.ndarray]) -> np.ndarray:
+        return np.concatenate(arrays)
+
+    def to_numpy(self, array: np.ndarray) -> np.ndarray:
+        return array
+
+    def from_numpy(self, array: np.ndarray, device: str) -> np.ndarray:
+        return array
+
+    def deduplicate_tiles(
+        self, source_tiles: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        unique_tiles, tile_indices = np.unique(
+            source_tiles, axis=0, return_inverse=True
+        )
+        return unique_tiles, tile_indices.reshape(-1)
+
+    def find_closest_tiles(
+        self,
+        match_tiles: np.ndarray,
+        source_tiles: np.ndarray,
+        channel_weights: np.ndarray,
+        memory_budget: int = MEMORY_BUDGET,
+        metric: str = 'l1',
+    ) -> np.ndarray:
+        if metric == 'l2':
+            return find_closest_tiles_l2(
+                match_tiles, source_tiles, channel_weights, memory_budget
+            )
+        return find_closest_tiles_l1(
+            match_tiles, source_tiles, [channel_weights], memory_budget
+        )[0]
+
+    def find_closest_tiles_sweep(
+        self,
+        match_tiles: np.ndarray,
+        source_tiles: np.ndarray,
+        channel_weight_sets: List[np.ndarray],
+        memory_budget: int = MEMORY_BUDGET,
+        metric: str = 'l1',
+    ) -> np.ndarray:
+        if metric == 'l2':
+            return find_closest_tiles_l2_sweep(
+                match_tiles, source_tiles, channel_weight_sets, memory_budget
+            )
+        return find_closest_tiles_l1(
+            match_tiles, source_tiles, channel_weight_sets, memory_budget
+        )
+
+    def tile_distances(
+        self,
+        match_tiles: np.ndarray,
+        source_tiles: np.ndarray,
+        channel_weights: np.ndarray,
+        metric: str = 'l1',
+    ) -> np.ndarray:
+        if metric == 'l2':
+            differences = weighted_features(
+                source_tiles, channel_weights
+            ) - weighted_features(match_tiles, channel_weights)
+            return np.square(differences, out=differences).sum(1)
+        differences = np.maximum(source_tiles, match_tiles)
+        differences -= np.minimum(source_tiles, match_tiles)
+        return (
+            differences.sum(2, dtype=channel_sum_dtype(differences))
+            @ channel_weights
+        )
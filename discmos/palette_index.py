@@ -0,0 +1,310 @@
+import hashlib
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+import torch
+
+from .constants import (
+    LUT_FILE,
+    LUT_LEVELS,
+    MEMORY_BUDGET,
+    PREFILTER_DIMENSIONS,
+    PREFILTER_FILE,
+    TOP_K,
+)
+from .files import atomic_write
+from .profiling import profiled
+from .torch_backend import channel_distances, weighted_features
+
+PcaPrefilter = Dict[str, torch.Tensor]
+
+
+def palette_key(
+    match_tiles: torch.Tensor, channel_weights: torch.Tensor, size: int
+) -> str:
+    digest = hashlib.sha1()
+    digest.update(match_tiles.cpu().numpy().tobytes())
+    digest.update(str(match_tiles.shape).encode())
+    digest.update(str(channel_weights.tolist()).encode())
+    digest.update(str(size).encode())
+    return digest.hexdigest()
+
+
+def build_prefilter(
+    match_tiles: torch.Tensor,
+    channel_weights: torch.Tensor,
+    dimensions: int = PREFILTER_DIMENSIONS,
+) -> PcaPrefilter:
+    features = weighted_features(match_tiles, channel_weights).double()
+    mean = features.mean(0)
+    centered = features - mean
+    covariance = centered.T @ centered / max(1, len(features) - 1)
+    # eigh sorts eigenvalues in ascending order, so the principal
+    # components are the last columns
+    _, eigenvectors = torch.linalg.eigh(covariance)
+    components = eigenvectors[:, -dimensions:].flip(1)
+    return {
+        'mean': mean.float(),
+        'components': components.float(),
+        'projected': (centered @ components).float(),
+    }
+
+
+@profiled('load_prefilter')
+def load_prefilter(
+    match_tiles: torch.Tensor,
+    channel_weights: torch.Tensor,
+    resize: Tuple[int, int],
+    resample: int,
+    cache_path: Optional[Path] = None,
+    dimensions: int = PREFILTER_DIMENSIONS,
+) -> PcaPrefilter:
+    if cache_path is None:
+        return build_prefilter(match_tiles, channel_weights, dimensions)
+
+    prefilter_path = cache_path.joinpath(
+        PREFILTER_FILE.format(w=resize[0], h=resize[1], resample=int(resample))
+    )
+    key = palette_key(match_tiles, channel_weights, dimensions)
+    device = match_tiles.device
+
+    if prefilter_path.is_file():
+        saved = torch.load(prefilter_path)
+        if saved['key'] == key:
+            return {
+                name: tensor.to(device)
+                for name, tensor in saved['prefilter'].items()
+            }
+
+    prefilter = build_prefilter(match_tiles, channel_weights, dimensions)
+    cache_path.mkdir(exist_ok=True)
+    # A truncated prefilter would fail to load on the next run
+    with atomic_write(prefilter_path) as temp_path:
+        torch.save(
+            {
+                'key': key,
+                'prefilter': {
+                    name: tensor.cpu() for name, tensor in prefilter.items()
+                },
+            },
+            temp_path,
+        )
+    return prefilter
+
+
+def thumbnail_features(
+    tiles: torch.Tensor,
+    channel_weights: torch.Tensor,
+    resize: Tuple[int, int],
+) -> torch.Tensor:
+    # Weighted sums of each channel over the quarters of each tile (2x2
+    # thumbnail). By the triangle inequality, the L1 distance between sums
+    # never exceeds the exact distance between the pixels they cover
+    width, height = resize
+    tiles = tiles.type(torch.float32).reshape(len(tiles), 3, height, width)
+    row_groups = tiles.tensor_split(min(2, height), dim=2)
+    cells = [
+        cell.sum((2, 3))
+        for row_group in row_groups
+        for cell in row_group.tensor_split(min(2, width), dim=3)
+    ]
+    weights = channel_weights.type(torch.float32)[None, :, None]
+    return torch.stack(cells, 2).mul(weights).flatten(start_dim=1)
+
+
+def rerank_candidates(
+    match_tiles: torch.Tensor,
+    source_chunk: torch.Tensor,
+    channel_weights: torch.Tensor,
+    candidates: torch.Tensor,
+    metric: str = 'l1',
+) -> torch.Tensor:
+    # Sorted candidates make ties resolve to the earliest emoji, like the
+    # exact matcher
+    candidates = candidates.sort(1).values
+    candidate_tiles = match_tiles[candidates]
+    if metric == 'l2':
+        weights = channel_weights.type(torch.float32)[None, None, :, None]
+        differences = (
+            source_chunk.type(torch.float32)[:, None] - candidate_tiles
+        )
+        distances = differences.mul_(weights).square_().flatten(2).sum(2)
+    else:
+        distances = (
+            channel_distances(source_chunk[:, None], candidate_tiles)
+            * channel_weights
+        ).sum(2)
+    return candidates.gather(1, distances.argmin(1)[:, None])[:, 0]
+
+
+def candidate_block_size(
+    match_tiles: torch.Tensor,
+    source_count: int,
+    top_k: int,
+    memory_budget: int,
+    metric: str = 'l1',
+) -> int:
+    # Candidate reranking dominates memory: one (top_k, channel, pixel)
+    # block per source tile, gathered in uint8 and compared in uint8 for
+    # L1 or float32 for L2
+    value_bytes = 4 if metric == 'l2' else 2
+    tile_bytes = max(
+        top_k * match_tiles[0].numel() * value_bytes, len(match_tiles) * 4
+    )
+    return max(1, min(source_count, memory_budget // tile_bytes))
+
+
+@profiled('find_closest_tiles_approximate')
+def find_closest_tiles_approximate(
+    match_tiles: torch.Tensor,
+    source_tiles: torch.Tensor,
+    channel_weights: torch.Tensor,
+    prefilter: PcaPrefilter,
+    top_k: int = TOP_K,
+    memory_budget: int = MEMORY_BUDGET,
+    metric: str = 'l1',
+) -> torch.Tensor:
+    # A prefilter rather than an index: every emoji is still compared with
+    # every tile in the reduced space, so the time grows linearly with the
+    # palette, only more slowly than exact matching
+    if top_k < 1:
+        raise ValueError(f'top_k must be at least 1, got {top_k}')
+    top_k = min(top_k, len(match_tiles))
+    source_block = candidate_block_size(
+        match_tiles, len(source_tiles), top_k, memory_budget, metric
+    )
+
+    closest_tiles = torch.empty(
+        len(source_tiles), dtype=torch.long, device=source_tiles.device
+    )
+    for source_start in range(0, len(source_tiles), source_block):
+        source_chunk = source_tiles[source_start : source_start + source_block]
+        projected = (
+            weighted_features(source_chunk, channel_weights)
+            - prefilter['mean']
+        ) @ prefilter['components']
+
+        candidates = (
+            torch.cdist(projected, prefilter['projected'])
+            .topk(top_k, dim=1, largest=False)
+            .indices
+        )
+        closest_tiles[source_start : source_start + source_block] = (
+            rerank_candidates(
+                match_tiles, source_chunk, channel_weights, candidates, metric
+            )
+        )
+
+    return closest_tiles
+
+
+@profiled('find_closest_tiles_coarse')
+def find_closest_tiles_coarse(
+    match_tiles: torch.Tensor,
+    source_tiles: torch.Tensor,
+    channel_weights: torch.Tensor,
+    resize: Tuple[int, int],
+    top_k: int = TOP_K,
+    memory_budget: int = MEMORY_BUDGET,
+    metric: str = 'l1',
+) -> torch.Tensor:
+    if top_k < 1:
+        raise ValueError(f'top_k must be at least 1, got {top_k}')
+    top_k = min(top_k, len(match_tiles))
+    match_thumbnails = thumbnail_features(match_tiles, channel_weights, resize)
+    source_block = candidate_block_size(
+        match_tiles, len(source_tiles), top_k, memory_budget, metric
+    )
+
+    closest_tiles = torch.empty(
+        len(source_tiles), dtype=torch.long, device=source_tiles.device
+    )
+    for source_start in range(0, len(source_tiles), source_block):
+        source_chunk = source_tiles[source_start : source_start + source_block]
+        source_thumbnails = thumbnail_features(
+            source_chunk, channel_weights, resize
+        )
+
+        candidates = (
+            torch.cdist(source_thumbnails, match_thumbnails, p=1)
+            .topk(top_k, dim=1, largest=False)
+            .indices
+        )
+        closest_tiles[source_start : source_start + source_block] = (
+            rerank_candidates(
+                match_tiles, source_chunk, channel_weights, candidates, metric
+            )
+        )
+
+    return closest_tiles
+
+
+def build_color_lut(
+    match_tiles: torch.Tensor,
+    channel_weights: torch.Tensor,
+    levels: int = LUT_LEVELS,
+    memory_budget: int = MEMORY_BUDGET,
+    metric: str = 'l1',
+) -> torch.Tensor:
+    # The center of every quantized HSV color, matched like a 1x1 tile
+    step = 256 // levels
+    values = torch.arange(levels, device=match_tiles.device) * step + step // 2
+    colors = torch.cartesian_prod(values, values, values)
+
+    # Weights are non-negative, so weighting before the distance gives the
+    # same distance as weighting the channel differences
+    weights = channel_weights.type(torch.float32)
+    match_colors = match_tiles[:, :, 0].type(torch.float32) * weights
+    color_block = max(1, memory_budget // (len(match_tiles) * 4))
+
+    lut = torch.empty(len(colors), dtype=torch.long, device=colors.device)
+    for color_start in range(0, len(colors), color_block):
+        color_chunk = colors[color_start : color_start + color_block]
+        lut[color_start : color_start + color_block] = torch.cdist(
+            color_chunk.type(torch.float32) * weights,
+            match_colors,
+            p=1 if metric == 'l1' else 2,
+        ).argmin(1)
+    return lut.reshape(levels, levels, levels)
+
+
+@profiled('load_color_lut')
+def load_color_lut(
+    match_tiles: torch.Tensor,
+    channel_weights: torch.Tensor,
+    resample: int,
+    cache_path: Optional[Path] = None,
+    levels: int = LUT_LEVELS,
+    memory_budget: int = MEMORY_BUDGET,
+    metric: str = 'l1',
+) -> torch.Tensor:
+    if cache_path is None:
+        return build_color_lut(
+            match_tiles, channel_weights, levels, memory_budget, metric
+        )
+
+    lut_path = cache_path.joinpath(
+        LUT_FILE.format(levels=levels, metric=metric, resample=int(resample))
+    )
+    key = palette_key(match_tiles, channel_weights, levels)
+
+    if lut_path.is_file():
+        saved = torch.load(lut_path)
+        if saved['key'] == key:
+            return saved['lut'].to(match_tiles.device)
+
+    lut = build_color_lut(
+        match_tiles, channel_weights, levels, memory_budget, metric
+    )
+    cache_path.mkdir(exist_ok=True)
+    with atomic_write(lut_path) as temp_path:
+        torch.save({'key': key, 'lut': lut.cpu()}, temp_path)
+    return lut
+
+
+def find_closest_tiles_lut(
+    source_tiles: torch.Tensor, lut: torch.Tensor
+) -> torch.Tensor:
+    step = 256 // len(lut)
+    colors = source_tiles[:, :, 0].long() // step
+    return lut[colors[:, 0], colors[:, 1], colors[:, 2]]
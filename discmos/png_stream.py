@@ -0,0 +1,97 @@
+import struct
+import zlib
+from typing import BinaryIO, Tuple
+
+import numpy as np
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def filter_row(row: np.ndarray, previous_row: np.ndarray) -> np.ndarray:
+    # Every filter type only predicts from unfiltered bytes, so all five
+    # are computed with whole-row operations, and the one with the smallest
+    # sum of absolute values is kept like libpng does. Bytes wrap around
+    # like the PNG filters expect, so most of this is uint8.
+    up = previous_row
+    left = np.zeros_like(row)
+    left[3:] = row[:-3]
+    up_left = np.zeros_like(row)
+    up_left[3:] = up[:-3]
+
+    up_difference = up.astype(np.int16) - up_left
+    left_difference = left.astype(np.int16) - up_left
+    left_distance = np.abs(up_difference)
+    up_distance = np.abs(left_difference)
+    up_left_distance = np.abs(up_difference + left_difference)
+    paeth = np.where(
+        (left_distance <= up_distance) & (left_distance <= up_left_distance),
+        left,
+        np.where(up_distance <= up_left_distance, up, up_left),
+    )
+    average = (left >> 1) + (up >> 1) + (left & up & 1)
+    candidates = np.stack(
+        [row, row - left, row - up, row - average, row - paeth]
+    )
+
+    # min(byte, 256 - byte) is the absolute value of the byte as an int8
+    scores = np.minimum(candidates, 0 - candidates).sum(1, dtype=np.uint32)
+    filter_type = scores.argmin()
+    return np.concatenate([[filter_type], candidates[filter_type]]).astype(
+        np.uint8
+    )
+
+
+def png_chunk(chunk_type: bytes, data: bytes) -> bytes:
+    return (
+        struct.pack('>I', len(data))
+        + chunk_type
+        + data
+        + struct.pack('>I', zlib.crc32(chunk_type + data))
+    )
+
+
+class PngWriter:
+    '''
+    Writes an 8-bit RGB PNG a band of rows at a time, so only one band has
+    to be in memory.
+    '''
+
+    def __init__(
+        self, file: BinaryIO, size: Tuple[int, int], compress_level: int = 6
+    ) -> None:
+        self.file = file
+        self.size = size
+        self.rows_written = 0
+        self.previous_row = np.zeros(size[0] * 3, dtype=np.uint8)
+        self.compressor = zlib.compressobj(compress_level)
+        header = struct.pack('>IIBBBBB', size[0], size[1], 8, 2, 0, 0, 0)
+        file.write(PNG_SIGNATURE)
+        file.write(png_chunk(b'IHDR', header))
+
+    def write_rows(self, pixels: np.ndarray) -> None:
+        if pixels.shape[1:] != (self.size[0], 3):
+            raise ValueError(
+                f'Expected rows of shape {(self.size[0], 3)}, '
+                f'got {pixels.shape[1:]}'
+            )
+        # Rows are filtered one at a time, which keeps the work in cache
+        rows = pixels.reshape(len(pixels), -1)
+        chunks = []
+        for row in rows:
+            filtered = filter_row(row, self.previous_row)
+            chunks.append(self.compressor.compress(filtered.data))
+            self.previous_row = row
+        # The caller may reuse the band's buffer for the next band
+        self.previous_row = rows[-1].copy()
+        data = b''.join(chunks)
+        if data:
+            self.file.write(png_chunk(b'IDAT', data))
+        self.rows_written += len(rows)
+
+    def close(self) -> None:
+        if self.rows_written != self.size[1]:
+            raise ValueError(
+                f'Expected {self.size[1]} rows, got {self.rows_written}'
+            )
+        self.file.write(png_chunk(b'IDAT', self.compressor.flush()))
+        self.file.write(png_chunk(b'IEND', b''))
@@ -0,0 +1,224 @@
+import contextlib
+import functools
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+from typing import (
+    Any,
+    Callable,
+    ContextManager,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+)
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+NULL_CONTEXT = contextlib.nullcontext()
+
+
+def peak_rss() -> Optional[int]:
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kibibytes elsewhere
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def cuda_module() -> Optional[Any]:
+    # Only look at CUDA if something else already imported torch, so that
+    # profiling never imports it
+    torch = sys.modules.get('torch')
+    if torch is not None and torch.cuda.is_available():
+        return torch.cuda
+    return None
+
+
+class Profiler:
+    def __init__(self, trace_python: bool = False) -> None:
+        self.records: List[Dict[str, Any]] = []
+        self.local = threading.local()
+        self.start_time = time.perf_counter()
+        # tracemalloc slows down every allocation, so the Python heap is only
+        # traced when asked for, and the timings are skewed when it is
+        self.trace_python = trace_python
+        # The peaks of tracemalloc and CUDA are global to the process, so
+        # every stage that is open in any thread shares them
+        self.lock = threading.Lock()
+        self.open_records: List[Dict[str, Any]] = []
+        if trace_python:
+            tracemalloc.start()
+
+    def stop(self) -> None:
+        if self.trace_python:
+            tracemalloc.stop()
+
+    def collect_peaks(self) -> None:
+        # The peaks since the last call were reached while every open stage
+        # was open, so they count for all of them, and resetting them here
+        # means that no stage resets the peak of another
+        if self.trace_python:
+            peak_python = tracemalloc.get_traced_memory()[1]
+            tracemalloc.reset_peak()
+            for record in self.open_records:
+                record['peak_python'] = max(record['peak_python'], peak_python)
+        cuda = cuda_module()
+        if cuda is not None:
+            peak_cuda = cuda.max_memory_allocated()
+            cuda.reset_peak_memory_stats()
+            for record in self.open_records:
+                record['peak_cuda'] = max(
+                    record.get('peak_cuda', 0), peak_cuda
+                )
+
+    @property
+    def stack(self) -> List[Dict[str, Any]]:
+        # Stages nest per thread, so batch decoding threads do not
+        # interleave with the matching stages
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> Iterator[Dict[str, Any]]:
+        stack = self.stack
+        record = {
+            'name': name,
+            'depth': len(stack),
+            'thread': threading.get_ident(),
+            'start': time.perf_counter() - self.start_time,
+            'peak_python': 0 if self.trace_python else None,
+            'tensor_bytes': 0,
+        }
+        with self.lock:
+            self.collect_peaks()
+            self.records.append(record)
+            self.open_records.append(record)
+        stack.append(record)
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield record
+        finally:
+            record['wall'] = time.perf_counter() - wall_start
+            record['cpu'] = time.process_time() - cpu_start
+            record['peak_rss'] = peak_rss()
+            with self.lock:
+                self.collect_peaks()
+                self.open_records.remove(record)
+            stack.pop()
+            if stack:
+                stack[-1]['tensor_bytes'] += record['tensor_bytes']
+
+    def record_bytes(self, count: int) -> None:
+        stack = self.stack
+        if stack:
+            stack[-1]['tensor_bytes'] += count
+
+    def summary(self) -> str:
+        header = (
+            f'{"Stage":<32}{"Wall (s)":>10}{"CPU (s)":>10}'
+            f'{"Python (MiB)":>14}{"RSS (MiB)":>11}{"Tensors (MiB)":>15}'
+        )
+        lines = [header]
+        # Keep the stages of each thread together so that nesting reads
+        # correctly
+        threads: Dict[int, int] = {}
+        for record in self.records:
+            threads.setdefault(record['thread'], len(threads))
+        records = sorted(
+            (record for record in self.records if 'wall' in record),
+            key=lambda record: threads[record['thread']],
+        )
+        for record in records:
+            python = record['peak_python']
+            rss = record['peak_rss']
+            lines.append(
+                f'{"  " * record["depth"] + record["name"]:<32}'
+                f'{record["wall"]:>10.4f}{record["cpu"]:>10.4f}'
+                f'{"-" if python is None else f"{python / 2**20:.1f}":>14}'
+                f'{"-" if rss is None else f"{rss / 2**20:.0f}":>11}'
+                f'{record["tensor_bytes"] / 2**20:>15.1f}'
+            )
+        return '\n'.join(lines)
+
+    def save(self, path: Path, trace_format: str = 'json') -> None:
+        records = [record for record in self.records if 'wall' in record]
+        if trace_format == 'chrome':
+            events = [
+                {
+                    'name': record['name'],
+                    'ph': 'X',
+                    'ts': record['start'] * 1e6,
+                    'dur': record['wall'] * 1e6,
+                    'pid': os.getpid(),
+                    'tid': record['thread'],
+                    'args': {
+                        key: value
+                        for key, value in record.items()
+                        if key not in ('name', 'start', 'wall', 'thread')
+                    },
+                }
+                for record in records
+            ]
+            path.write_text(json.dumps({'traceEvents': events}))
+        else:
+            path.write_text(json.dumps(records, indent=2))
+
+
+profiler: Optional[Profiler] = None
+
+
+def start_profiling(trace_python: bool = False) -> Profiler:
+    global profiler
+    profiler = Profiler(trace_python)
+    return profiler
+
+
+def stop_profiling() -> None:
+    global profiler
+    if profiler is not None:
+        profiler.stop()
+    profiler = None
+
+
+def stage(name: str) -> ContextManager:
+    if profiler is None:
+        return NULL_CONTEXT
+    return profiler.stage(name)
+
+
+def record_bytes(count: int) -> None:
+    if profiler is not None:
+        profiler.record_bytes(count)
+
+
+def record_tensor(tensor: Any) -> None:
+    if profiler is not None:
+        # NumPy arrays have nbytes, torch tensors have element_size
+        if hasattr(tensor, 'element_size'):
+            profiler.record_bytes(tensor.element_size() * tensor.nelement())
+        else:
+            profiler.record_bytes(tensor.nbytes)
+
+
+def profiled(name: str) -> Callable[[Callable], Callable]:
+    def decorator(function: Callable) -> Callable:
+        @functools.wraps(function)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            if profiler is None:
+                return function(*args, **kwargs)
+            with profiler.stage(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
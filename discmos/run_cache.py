@@ -0,0 +1,181 @@
+import hashlib
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .backend import Array, get_backend
+from .classes import Emoji
+from .constants import MATCH_STATE_FILE, MEMORY_BUDGET, SOURCE_TILES_FILE
+from .files import atomic_write
+from .profiling import profiled, record_tensor
+
+
+def source_key(
+    source_path: Path,
+    width_emojis: int,
+    resize: Tuple[int, int],
+    resample: int,
+) -> str:
+    digest = hashlib.sha1(source_path.read_bytes())
+    digest.update(f'{width_emojis} {resize} {int(resample)}'.encode())
+    return digest.hexdigest()
+
+
+def match_state_path(
+    cache_path: Path,
+    key: str,
+    channel_weights: Array,
+    metric: str,
+) -> Path:
+    # Distances depend on the weights and the metric, and the order of the
+    # unique tiles depends on the backend
+    digest = hashlib.sha1(key.encode())
+    digest.update(str(channel_weights.tolist()).encode())
+    digest.update(f'{metric} {get_backend().name}'.encode())
+    state_file = MATCH_STATE_FILE.format(key=digest.hexdigest())
+    return cache_path.joinpath(state_file)
+
+
+@profiled('read_source_tiles')
+def read_source_tiles(cache_path: Path, key: str) -> Optional[Array]:
+    tiles_path = cache_path.joinpath(SOURCE_TILES_FILE.format(key=key))
+    if not tiles_path.is_file():
+        return None
+    tiles = np.load(tiles_path)
+    # Tiles cached by older versions were int16 and are computed again
+    if tiles.dtype != np.uint8:
+        return None
+    backend = get_backend()
+    tiles = backend.from_numpy(tiles, backend.device)
+    record_tensor(tiles)
+    return tiles
+
+
+def write_source_tiles(cache_path: Path, key: str, tiles: Array) -> None:
+    tiles_path = cache_path.joinpath(SOURCE_TILES_FILE.format(key=key))
+    cache_path.mkdir(exist_ok=True)
+    with atomic_write(tiles_path, '.tmp.npy') as temp_path:
+        np.save(temp_path, get_backend().to_numpy(tiles))
+
+
+def emoji_digests(match_tiles: np.ndarray) -> np.ndarray:
+    # Emojis are identified by ID and by their features, so that an emoji
+    # whose image changed is treated as removed and added again
+    return np.array(
+        [
+            int.from_bytes(hashlib.sha1(tile.tobytes()).digest()[:8], 'little')
+            for tile in match_tiles
+        ],
+        dtype=np.uint64,
+    )
+
+
+def read_match_state(state_path: Path) -> Optional[Dict[str, np.ndarray]]:
+    if not state_path.is_file():
+        return None
+    with np.load(state_path) as state:
+        return dict(state)
+
+
+def write_match_state(state_path: Path, **state: np.ndarray) -> None:
+    state_path.parent.mkdir(exist_ok=True)
+    with atomic_write(state_path) as temp_path:
+        with open(temp_path, 'wb') as file:
+            np.savez(file, **state)
+
+
+@profiled('find_closest_tiles_incremental')
+def find_closest_tiles_incremental(
+    emojis: List[Emoji],
+    match_tiles: Array,
+    source_tiles: Array,
+    channel_weights: Array,
+    state_path: Path,
+    memory_budget: int = MEMORY_BUDGET,
+    metric: str = 'l1',
+    stats: Optional[Dict[str, float]] = None,
+) -> Array:
+    backend = get_backend()
+    ids = np.array([emoji.id for emoji in emojis], dtype=np.uint64)
+    digests = emoji_digests(backend.to_numpy(match_tiles))
+
+    def match(
+        palette_positions: Optional[np.ndarray], tile_positions: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        palette = match_tiles
+        if palette_positions is not None:
+            palette = match_tiles[
+                backend.from_numpy(palette_positions, backend.device)
+            ]
+        tiles = source_tiles[
+            backend.from_numpy(tile_positions, backend.device)
+        ]
+        closest = backend.find_closest_tiles(
+            palette, tiles, channel_weights, memory_budget, metric
+        )
+        distances = backend.tile_distances(
+            palette[closest], tiles, channel_weights, metric
+        )
+        closest = backend.to_numpy(closest)
+        if palette_positions is not None:
+            closest = palette_positions[closest]
+        return closest, backend.to_numpy(distances)
+
+    state = read_match_state(state_path)
+    all_tiles = np.arange(len(source_tiles))
+    if state is None or len(state['closest']) != len(source_tiles):
+        closest, distances = match(None, all_tiles)
+        new_count = len(emojis)
+        rescanned_tiles = all_tiles
+    else:
+        positions = {
+            key: position
+            for position, key in enumerate(zip(ids.tolist(), digests.tolist()))
+        }
+        scored_positions = np.array(
+            [
+                positions.get(key, -1)
+                for key in zip(
+                    state['ids'].tolist(), state['digests'].tolist()
+                )
+            ],
+            dtype=np.int64,
+        )
+        closest = scored_positions[state['closest']]
+        distances = state['distances']
+        kept_tiles = np.flatnonzero(closest >= 0)
+
+        # Tiles whose closest emoji was removed are matched again against
+        # the whole palette
+        rescanned_tiles = np.flatnonzero(closest < 0)
+        if len(rescanned_tiles):
+            closest[rescanned_tiles], distances[rescanned_tiles] = match(
+                None, rescanned_tiles
+            )
+
+        # Other tiles only compare new emojis against their stored closest
+        # emoji, keeping the earliest emoji on ties like the exact matcher
+        new_positions = np.setdiff1d(np.arange(len(emojis)), scored_positions)
+        new_count = len(new_positions)
+        if new_count and len(kept_tiles):
+            new_closest, new_distances = match(new_positions, kept_tiles)
+            old_closest = closest[kept_tiles]
+            old_distances = distances[kept_tiles]
+            closer = (new_distances < old_distances) | (
+                (new_distances == old_distances) & (new_closest < old_closest)
+            )
+            closest[kept_tiles[closer]] = new_closest[closer]
+            distances[kept_tiles[closer]] = new_distances[closer]
+
+    write_match_state(
+        state_path,
+        ids=ids,
+        digests=digests,
+        closest=closest,
+        distances=distances,
+    )
+    if stats is not None:
+        stats['new_emojis'] = new_count
+        stats['rescanned_tiles'] = len(rescanned_tiles)
+    return backend.from_numpy(closest, backend.device)
@@ -0,0 +1,258 @@
+import io
+import queue
+import socket
+import socketserver
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+from PIL import Image, UnidentifiedImageError
+
+from .backend import Array, get_backend
+from .classes import Emoji
+from .constants import MEMORY_BUDGET, SERVER_BATCH_WINDOW
+from .emoji_data import emojis_from_workspace
+from .emoji_store import collapse_duplicates
+from .mosaic import (
+    deduplicate_tiles,
+    emojis_to_text,
+    find_closest_tiles,
+    get_channel_weights,
+    get_device,
+    load_match_tiles,
+    load_source_tiles,
+    render_composite,
+    to_device,
+)
+
+
+@dataclass
+class MosaicJob:
+    source_tiles: Array
+    width_emojis: int
+    resize: int
+    weights: Tuple[float, float, float]
+    future: Future = field(default_factory=Future)
+
+
+class MosaicServer:
+    def __init__(
+        self,
+        workspace: Path,
+        memory_budget: int = MEMORY_BUDGET,
+        batch_window: float = SERVER_BATCH_WINDOW,
+    ) -> None:
+        self.workspace = workspace
+        self.memory_budget = memory_budget
+        self.batch_window = batch_window
+        self.device = get_device()
+        self.jobs: 'queue.Queue[MosaicJob]' = queue.Queue()
+        self.fingerprint: Optional[Tuple] = None
+        self.emojis: List[Emoji] = []
+        self.palettes: Dict[int, Array] = {}
+        self.reload_if_changed()
+        threading.Thread(target=self.run_worker, daemon=True).start()
+
+    def workspace_fingerprint(self) -> Tuple:
+        paths = (
+            self.workspace.joinpath('include.txt'),
+            self.workspace.joinpath('emoji-data.json'),
+            # Downloads rename files into place, which updates the
+            # directory modification time
+            self.workspace.joinpath('emojis'),
+        )
+        return tuple(
+            (path.stat().st_mtime_ns, path.stat().st_size) for path in paths
+        )
+
+    def reload_if_changed(self) -> None:
+        fingerprint = self.workspace_fingerprint()
+        if fingerprint != self.fingerprint:
+            self.emojis = collapse_duplicates(
+                emojis_from_workspace(self.workspace),
+                self.workspace.joinpath('emojis'),
+            )
+            self.palettes.clear()
+            self.fingerprint = fingerprint
+
+    def palette(self, resize: int) -> Array:
+        if resize not in self.palettes:
+            match_tiles = load_match_tiles(
+                self.emojis,
+                self.workspace.joinpath('emojis'),
+                (resize, resize),
+                Image.LANCZOS,
+                self.workspace.joinpath('cache'),
+            )
+            self.palettes[resize] = to_device(match_tiles, self.device)
+        return self.palettes[resize]
+
+    def submit(
+        self,
+        source: bytes,
+        width_emojis: int,
+        resize: int,
+        weights: Tuple[float, float, float],
+    ) -> List[List[Emoji]]:
+        # Decoding runs on the request thread, so only matching is serial
+        source_tiles = load_source_tiles(
+            io.BytesIO(source), width_emojis, (resize, resize), Image.LANCZOS
+        )
+        job = MosaicJob(source_tiles, width_emojis, resize, weights)
+        self.jobs.put(job)
+        return job.future.result()
+
+    def run_worker(self) -> None:
+        while True:
+            jobs = [self.jobs.get()]
+            deadline = time.monotonic() + self.batch_window
+            while (remaining := deadline - time.monotonic()) > 0:
+                try:
+                    jobs.append(self.jobs.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            groups: Dict[Tuple, List[MosaicJob]] = {}
+            for job in jobs:
+                groups.setdefault((job.resize, job.weights), []).append(job)
+            for (resize, weights), group in groups.items():
+                try:
+                    self.run_group(resize, weights, group)
+                except Exception as error:
+                    # Jobs that already got their mosaic keep it, and the
+                    # worker keeps serving the other groups
+                    for job in group:
+                        if not job.future.done():
+                            job.future.set_exception(error)
+
+    def run_group(
+        self,
+        resize: int,
+        weights: Tuple[float, float, float],
+        jobs: List[MosaicJob],
+    ) -> None:
+        self.reload_if_changed()
+        match_tiles = self.palette(resize)
+        channel_weights = get_channel_weights(*weights, self.device)
+        source_tiles = get_backend().concatenate(
+            [job.source_tiles for job in jobs]
+        )
+        source_tiles, tile_indices = deduplicate_tiles(
+            to_device(source_tiles, self.device)
+        )
+
+        closest_tiles = find_closest_tiles(
+            match_tiles, source_tiles, channel_weights, self.memory_budget
+        )[tile_indices]
+
+        job_start = 0
+        for job in jobs:
+            job_end = job_start + len(job.source_tiles)
+            job_tiles = closest_tiles[job_start:job_end]
+            job_start = job_end
+            job.future.set_result(
+                [
+                    [self.emojis[index] for index in row]
+                    for row in job_tiles.reshape(
+                        (job.width_emojis, -1)
+                    ).T.tolist()
+                ]
+            )
+
+
+class MosaicRequestHandler(BaseHTTPRequestHandler):
+    server: 'MosaicHTTPServer'
+
+    def send_body(self, status: int, content_type: str, body: bytes) -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self) -> None:
+        url = urlparse(self.path)
+        if url.path != '/mosaic':
+            self.send_body(404, 'text/plain', b'Not found')
+            return
+
+        try:
+            query = {
+                name: values[-1]
+                for name, values in parse_qs(url.query).items()
+            }
+            width_emojis = int(query['width'])
+            resize = int(query.get('resize', 8))
+            weights = (
+                float(query.get('hue_weight', 1)),
+                float(query.get('saturation_weight', 1)),
+                float(query.get('value_weight', 1)),
+            )
+            output = query.get('format', 'text')
+            image_width = int(query.get('image_width', 1000))
+            if output not in ('text', 'png'):
+                raise ValueError(f'Unknown format "{output}"')
+            source = self.rfile.read(int(self.headers['Content-Length']))
+        except (KeyError, TypeError, ValueError) as error:
+            self.send_body(400, 'text/plain', f'Bad request: {error}'.encode())
+            return
+
+        try:
+            output_emojis = self.server.mosaic.submit(
+                source, width_emojis, resize, weights
+            )
+        except UnidentifiedImageError as error:
+            self.send_body(400, 'text/plain', f'Bad image: {error}'.encode())
+            return
+        except Exception as error:
+            self.send_body(500, 'text/plain', f'Error: {error}'.encode())
+            return
+
+        if output == 'text':
+            body = emojis_to_text(output_emojis).encode()
+            self.send_body(200, 'text/plain; charset=utf-8', body)
+            return
+
+        try:
+            image = render_composite(
+                output_emojis,
+                self.server.mosaic.workspace.joinpath('emojis'),
+                image_width,
+            )
+            image_bytes = io.BytesIO()
+            image.save(image_bytes, 'PNG')
+        except Exception as error:
+            self.send_body(500, 'text/plain', f'Error: {error}'.encode())
+            return
+        self.send_body(200, 'image/png', image_bytes.getvalue())
+
+    def address_string(self) -> str:
+        # Unix socket clients have no address
+        return str(self.client_address[0]) if self.client_address else '-'
+
+
+class MosaicHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], mosaic: MosaicServer) -> None:
+        super().__init__(address, MosaicRequestHandler)
+        self.mosaic = mosaic
+
+
+class MosaicUnixHTTPServer(MosaicHTTPServer):
+    address_family = socket.AF_UNIX
+
+    def __init__(self, path: Path, mosaic: MosaicServer) -> None:
+        path.unlink(missing_ok=True)
+        super().__init__(str(path), mosaic)
+
+    def server_bind(self) -> None:
+        # HTTPServer.server_bind expects a (host, port) address
+        socketserver.TCPServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 0
@@ -0,0 +1,262 @@
+from typing import List, Tuple
+
+import numpy as np
+import torch
+from PIL import Image
+
+from . import profiling
+from .backend import Backend, block_sizes
+from .constants import MEMORY_BUDGET
+from .image_tensor import image_to_tensor, image_to_tiles
+
+
+def weighted_features(
+    tiles: torch.Tensor, channel_weights: torch.Tensor
+) -> torch.Tensor:
+    weights = channel_weights.type(torch.float32)[None, :, None]
+    return tiles.type(torch.float32).mul(weights).flatten(start_dim=1)
+
+
+def channel_distances(
+    source_tiles: torch.Tensor, match_tiles: torch.Tensor
+) -> torch.Tensor:
+    # Sums of |s - m| over the pixels of each channel. 2 max(s, m) - s - m
+    # wraps around to |s - m| in uint8, so the broadcast block takes one
+    # byte per value, and the sums fit in int16 up to 128 pixels per tile
+    differences = torch.maximum(source_tiles, match_tiles)
+    differences.mul_(2).sub_(source_tiles).sub_(match_tiles)
+    dtype = torch.short if differences.shape[-1] * 255 < 2**15 else torch.int
+    return differences.sum(-1, dtype=dtype)
+
+
+def find_closest_tiles_l1(
+    match_tiles: torch.Tensor,
+    source_tiles: torch.Tensor,
+    channel_weight_sets: List[torch.Tensor],
+    memory_budget: int = MEMORY_BUDGET,
+) -> torch.Tensor:
+    # Tiles stay uint8, and the weights are applied to the per-channel sums,
+    # which is exact for integer weights. The sums of a block are shared by
+    # every set of weights, so a sweep costs little more than one run
+    pair_bytes = match_tiles[0].numel() * match_tiles.element_size()
+    match_block, source_block = block_sizes(
+        len(match_tiles), len(source_tiles), pair_bytes, memory_budget
+    )
+    profiling.record_bytes(match_block * source_block * pair_bytes)
+
+    closest_tiles = torch.empty(
+        (len(channel_weight_sets), len(source_tiles)),
+        dtype=torch.long,
+        device=source_tiles.device,
+    )
+    for source_start in range(0, len(source_tiles), source_block):
+        source_chunk = source_tiles[source_start : source_start + source_block]
+        best_distances = [None] * len(channel_weight_sets)
+        best_indices = [None] * len(channel_weight_sets)
+
+        for match_start in range(0, len(match_tiles), match_block):
+            match_chunk = match_tiles[match_start : match_start + match_block]
+            sums = channel_distances(source_chunk[:, None], match_chunk[None])
+            for set_index, channel_weights in enumerate(channel_weight_sets):
+                distances = (sums * channel_weights).sum(2)
+                indices = distances.argmin(1)
+                chunk_distances = distances.gather(1, indices[:, None])[:, 0]
+                indices += match_start
+
+                if best_distances[set_index] is None:
+                    best_distances[set_index] = chunk_distances
+                    best_indices[set_index] = indices
+                else:
+                    # Strictly less keeps the earliest index on ties, like
+                    # argmin
+                    closer = chunk_distances < best_distances[set_index]
+                    best_distances[set_index] = torch.where(
+                        closer, chunk_distances, best_distances[set_index]
+                    )
+                    best_indices[set_index] = torch.where(
+                        closer, indices, best_indices[set_index]
+                    )
+
+        closest_tiles[:, source_start : source_start + source_block] = (
+            torch.stack(best_indices)
+        )
+
+    return closest_tiles
+
+
+def find_closest_tiles_l2(
+    match_tiles: torch.Tensor,
+    source_tiles: torch.Tensor,
+    channel_weights: torch.Tensor,
+    memory_budget: int = MEMORY_BUDGET,
+) -> torch.Tensor:
+    # |s - m|^2 = |s|^2 + |m|^2 - 2 s.m, and |s|^2 is the same for every
+    # emoji, so one matrix multiply per block ranks the whole palette. The
+    # terms pass 2^24 for large tiles, so they are summed in float64 to
+    # keep near ties in the right order
+    match_features = weighted_features(match_tiles, channel_weights).double()
+    match_norms = match_features.square().sum(1)
+    source_block = max(
+        1, min(len(source_tiles), memory_budget // (len(match_tiles) * 8))
+    )
+    profiling.record_tensor(match_features)
+    profiling.record_bytes(source_block * len(match_tiles) * 8)
+
+    closest_tiles = torch.empty(
+        len(source_tiles), dtype=torch.long, device=source_tiles.device
+    )
+    for source_start in range(0, len(source_tiles), source_block):
+        source_chunk = source_tiles[source_start : source_start + source_block]
+        source_features = weighted_features(
+            source_chunk, channel_weights
+        ).double()
+        distances = torch.addmm(
+            match_norms[None, :], source_features, match_features.T, alpha=-2
+        )
+        closest_tiles[source_start : source_start + source_block] = (
+            distances.argmin(1)
+        )
+
+    return closest_tiles
+
+
+def find_closest_tiles_l2_sweep(
+    match_tiles: torch.Tensor,
+    source_tiles: torch.Tensor,
+    channel_weight_sets: List[torch.Tensor],
+    memory_budget: int = MEMORY_BUDGET,
+) -> torch.Tensor:
+    # The weighted distance is sum_c w_c^2 (|m_c|^2 - 2 s_c.m_c) plus a
+    # constant per tile, so one batched matrix multiply per block gives the
+    # per-channel terms that every set of weights is ranked with, in
+    # float64 like find_closest_tiles_l2
+    match_features = match_tiles.type(torch.float64)
+    match_norms = match_features.square().sum(2).T[:, None, :]
+    match_features = match_features.permute(1, 2, 0)
+    squared_weights = [
+        channel_weights.type(torch.float64).square()
+        for channel_weights in channel_weight_sets
+    ]
+    source_block = max(
+        1, min(len(source_tiles), memory_budget // (len(match_tiles) * 32))
+    )
+    profiling.record_tensor(match_features)
+    profiling.record_bytes(source_block * len(match_tiles) * 32)
+
+    closest_tiles = torch.empty(
+        (len(channel_weight_sets), len(source_tiles)),
+        dtype=torch.long,
+        device=source_tiles.device,
+    )
+    for source_start in range(0, len(source_tiles), source_block):
+        source_chunk = source_tiles[source_start : source_start + source_block]
+        source_features = source_chunk.type(torch.float64).transpose(0, 1)
+        terms = torch.baddbmm(
+            match_norms, source_features, match_features, alpha=-2
+        )
+        for set_index, weights in enumerate(squared_weights):
+            closest_tiles[
+                set_index, source_start : source_start + source_block
+            ] = torch.tensordot(weights, terms, 1).argmin(1)
+
+    return closest_tiles
+
+
+class TorchBackend(Backend):
+    name = 'torch'
+
+    @property
+    def device(self) -> torch.device:
+        return torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    def to_device(
+        self, array: torch.Tensor, device: torch.device
+    ) -> torch.Tensor:
+        return array.to(device)
+
+    def tiles_from_image(
+        self, image: Image.Image, tile_size: Tuple[int, int]
+    ) -> torch.Tensor:
+        tiles = image_to_tiles(image_to_tensor(image), tile_size)
+        tiles = tiles.to(torch.uint8, memory_format=torch.contiguous_format)
+        return tiles.flatten(end_dim=1).flatten(start_dim=2)
+
+    def tiles_from_features(self, features: np.ndarray) -> torch.Tensor:
+        return torch.from_numpy(features).flatten(start_dim=2)
+
+    def channel_weights(
+        self, weights: List[float], device: torch.device
+    ) -> torch.Tensor:
+        dtype = (
+            torch.int
+            if all(weight.is_integer() for weight in weights)
+            else torch.float32
+        )
+        return torch.tensor(weights, dtype=dtype, device=device)
+
+    def concatenate(self, arrays: List[torch.Tensor]) -> torch.Tensor:
+        return torch.cat(arrays)
+
+    def to_numpy(self, array: torch.Tensor) -> np.ndarray:
+        return array.cpu().numpy()
+
+    def from_numpy(
+        self, array: np.ndarray, device: torch.device
+    ) -> torch.Tensor:
+        return torch.from_numpy(array).to(device)
+
+    def deduplicate_tiles(
+        self, source_tiles: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        unique_tiles, tile_indices = torch.unique(
+            source_tiles, dim=0, return_inverse=True
+        )
+        return unique_tiles, tile_indices
+
+    def find_closest_tiles(
+        self,
+        match_tiles: torch.Tensor,
+        source_tiles: torch.Tensor,
+        channel_weights: torch.Tensor,
+        memory_budget: int = MEMORY_BUDGET,
+        metric: str = 'l1',
+    ) -> torch.Tensor:
+        if metric == 'l2':
+            return find_closest_tiles_l2(
+                match_tiles, source_tiles, channel_weights, memory_budget
+            )
+        return find_closest_tiles_l1(
+            match_tiles, source_tiles, [channel_weights], memory_budget
+        )[0]
+
+    def find_closest_tiles_sweep(
+        self,
+        match_tiles: torch.Tensor,
+        source_tiles: torch.Tensor,
+        channel_weight_sets: List[torch.Tensor],
+        memory_budget: int = MEMORY_BUDGET,
+        metric: str = 'l1',
+    ) -> torch.Tensor:
+        if metric == 'l2':
+            return find_closest_tiles_l2_sweep(
+                match_tiles, source_tiles, channel_weight_sets, memory_budget
+            )
+        return find_closest_tiles_l1(
+            match_tiles, source_tiles, channel_weight_sets, memory_budget
+        )
+
+    def tile_distances(
+        self,
+        match_tiles: torch.Tensor,
+        source_tiles: torch.Tensor,
+        channel_weights: torch.Tensor,
+        metric: str = 'l1',
+    ) -> torch.Tensor:
+        if metric == 'l2':
+            differences = weighted_features(
+                source_tiles, channel_weights
+            ) - weighted_features(match_tiles, channel_weights)
+            return differences.square_().sum(1)
+        return (
+            channel_distances(source_tiles, match_tiles) * channel_weights
+        ).sum(1)
@@ -9,10 +9,17 @@ readme_path = os.path.join(dir_path, readme_file)
 with open(readme_path, 'r') as file:
     long_description = file.read()
 
-requirements_file = 'requirements.txt'
-requirements_path = os.path.join(dir_path, requirements_file)
-with open(requirements_path, 'r') as file:
-    requirements = [line.removesuffix('\n') for line in file.readlines()]
+
+def read_requirements(requirements_file: str) -> list[str]:
+    requirements_path = os.path.join(dir_path, requirements_file)
+    with open(requirements_path, 'r') as file:
+        return [line.removesuffix('\n') for line in file.readlines()]
+
+
+requirements = read_requirements('requirements.txt')
+# torch is only needed for the GPU and the approximate, coarse and lut
+# matchers, and NumPy is used without it
+torch_requirements = read_requirements('requirements-torch.txt')
 
 setup(
     name='discmos',
@@ -23,5 +30,6 @@ setup(
     packages=find_packages(),
     entry_points={'console_scripts': ['discmos = discmos.cli:cli']},
     install_requires=requirements,
+    extras_require={'torch': torch_requirements},
     classifiers=[],
 )
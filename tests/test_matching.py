@@ -0,0 +1,131 @@
+import importlib.util
+
+import numpy as np
+import pytest
+
+from discmos import backend as backend_module
+from discmos.classes import Emoji
+from discmos.run_cache import find_closest_tiles_incremental
+
+HAS_TORCH = importlib.util.find_spec('torch') is not None
+BACKENDS = [
+    'numpy',
+    pytest.param(
+        'torch',
+        marks=pytest.mark.skipif(not HAS_TORCH, reason='torch not installed'),
+    ),
+]
+# Small enough that every kernel splits the palette and the tiles into many
+# blocks, so ties across blocks are checked; integral weights keep the
+# distances exact so that ties are real ties
+MEMORY_BUDGET = 128
+
+
+@pytest.fixture(params=BACKENDS)
+def backend(request, monkeypatch):
+    monkeypatch.setattr(backend_module, 'backend', None)
+    return backend_module.set_backend(request.param)
+
+
+def random_tiles(rng, count, levels=4, pixels=4):
+    # Few levels and pixels make many tiles tie for the closest emoji
+    return rng.integers(0, levels, (count, 3, pixels), dtype=np.uint8)
+
+
+def brute_force(match_tiles, source_tiles, weights, metric):
+    differences = source_tiles[:, None].astype(np.int64) - match_tiles[
+        None
+    ].astype(np.int64)
+    weights = np.asarray(weights, dtype=np.int64)[:, None]
+    if metric == 'l2':
+        distances = np.square(differences * weights).sum((2, 3))
+    else:
+        distances = (np.abs(differences) * weights).sum((2, 3))
+    # argmin returns the first of equal distances, the lowest emoji index
+    return distances.argmin(1)
+
+
+def closest_tiles(backend, match_tiles, source_tiles, weights, metric):
+    device = backend.device
+    return backend.to_numpy(
+        backend.find_closest_tiles(
+            backend.from_numpy(match_tiles, device),
+            backend.from_numpy(source_tiles, device),
+            backend.channel_weights(weights, device),
+            MEMORY_BUDGET,
+            metric,
+        )
+    )
+
+
+@pytest.mark.parametrize('metric', ['l1', 'l2'])
+@pytest.mark.parametrize(
+    'weights', [[1.0, 1.0, 1.0], [3.0, 1.0, 2.0], [0.0, 2.0, 1.0]]
+)
+def test_blockwise_matches_brute_force(backend, metric, weights):
+    rng = np.random.default_rng(0)
+    match_tiles = random_tiles(rng, 37)
+    source_tiles = random_tiles(rng, 53)
+    assert np.array_equal(
+        closest_tiles(backend, match_tiles, source_tiles, weights, metric),
+        brute_force(match_tiles, source_tiles, weights, metric),
+    )
+
+
+@pytest.mark.skipif(not HAS_TORCH, reason='torch not installed')
+@pytest.mark.parametrize('metric', ['l1', 'l2'])
+def test_numpy_matches_torch(monkeypatch, metric):
+    rng = np.random.default_rng(1)
+    match_tiles = random_tiles(rng, 41, levels=256, pixels=16)
+    source_tiles = random_tiles(rng, 29, levels=256, pixels=16)
+    results = []
+    for name in ('numpy', 'torch'):
+        monkeypatch.setattr(backend_module, 'backend', None)
+        results.append(
+            closest_tiles(
+                backend_module.set_backend(name),
+                match_tiles,
+                source_tiles,
+                [2.0, 1.0, 3.0],
+                metric,
+            )
+        )
+    assert np.array_equal(*results)
+
+
+@pytest.mark.parametrize('metric', ['l1', 'l2'])
+def test_incremental_matches_fresh(backend, metric, tmp_path):
+    rng = np.random.default_rng(2)
+    tiles = random_tiles(rng, 60)
+    source_tiles = backend.from_numpy(random_tiles(rng, 45), backend.device)
+    weights = backend.channel_weights([2.0, 1.0, 1.0], backend.device)
+    state_path = tmp_path / 'match.npz'
+
+    def match(ids):
+        emojis = [Emoji(int(id), f'e{id}', 'server') for id in ids]
+        match_tiles = backend.from_numpy(tiles[ids], backend.device)
+        incremental = find_closest_tiles_incremental(
+            emojis,
+            match_tiles,
+            source_tiles,
+            weights,
+            state_path,
+            MEMORY_BUDGET,
+            metric,
+        )
+        fresh = backend.find_closest_tiles(
+            match_tiles, source_tiles, weights, MEMORY_BUDGET, metric
+        )
+        return backend.to_numpy(incremental), backend.to_numpy(fresh)
+
+    palettes = [
+        np.arange(10, 40),
+        # Emojis removed, including ones that were closest to some tiles
+        np.arange(10, 40, 2),
+        # Emojis added before, between and after the kept ones
+        np.concatenate([np.arange(0, 10), np.arange(10, 40, 2), [55, 59]]),
+        np.arange(60),
+    ]
+    for ids in palettes:
+        incremental, fresh = match(ids)
+        assert np.array_equal(incremental, fresh)